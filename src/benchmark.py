@@ -0,0 +1,261 @@
+# Benchmark of the processing stages with synthetic known data and specimen files.
+# Call example:     python benchmark.py --sizes 1000,10000,100000 --results benchmark.jsonl
+#
+# Known data files are generated in the paikkain_*.xlsx layout (column names, rules, reserved rows,
+# data), specimen files with the Kotka columns used by the rules. Localities repeat as in real
+# batches and are written with the abbreviations the replacement rules of the config file expand.
+# Each stage is timed separately and the results are appended to the results file as one
+# JSON object per line, so runs of different versions can be compared.
+
+import time, json, random, argparse, platform, datetime, tempfile, subprocess, logging
+from pathlib import Path
+import openpyxl
+import jksheet, jktools
+from jktest import known_test_types
+import paikkain
+
+progname = 'paikkain'
+log = logging.getLogger(progname)
+
+# Columns of the synthetic known data: (column name, rule)
+G = "MYGathering[0][%s]"
+gazetteer_columns = [ ("#", "no_output"), (G % "MYCountry", "equal"), (G % "MYAdministrativeProvince", "equal"),
+    (G % "MYBiologicalProvince", "equal"), (G % "MYMunicipality", "equal"), (G % "MYLocality", "equal"),
+    (G % "MYLocalityDescription", "equal"), (G % "MYDateBegin", "dateafter"), (G % "MYDateBegin", "datebefore"),
+    ("NEW", "no_output"), (G % "MYCountry", "replace"), (G % "MYHigherGeography", None),
+    (G % "MYBiologicalProvince", "fillempty"), (G % "MYMunicipality", "replace"), (G % "MYLatitude", "replace"),
+    (G % "MYLongitude", "replace"), (G % "MYCoordinateRadius", "replace"), (G % "MYCoordinateSystem", "replace"),
+    (G % "MYGeoreferenceSource", "replace"), (G % "MYCoordinateNotes", "append") ]
+# Columns of the synthetic specimen files. The first ones are the rule columns.
+specimen_columns = [ G % "MYCountry", G % "MYAdministrativeProvince", G % "MYBiologicalProvince",
+    G % "MYMunicipality", G % "MYLocality", G % "MYLocalityDescription", G % "MYDateBegin",
+    "MYNamespaceID", "MYObjectID", "MYGathering[0][MYUnit][0][MYIdentification][0][MYTaxon]",
+    "MYGathering[0][MYUnit][0][MYIdentification][0][MYAuthor]", G % "MYLeg][0", G % "MYLatitude",
+    G % "MYLongitude", G % "MYCoordinateSystem", G % "MYCoordinateRadius", G % "MYCoordinateNotes",
+    G % "MYDateEnd", "MYGathering[0][MYUnit][0][MYRecordBasis]", "MYGathering[0][MYUnit][0][MYCount]" ]
+
+provinces = ["A", "Ab", "N", "Ka", "St", "Ta", "Sa", "Oa", "Tb", "Sb", "Kb", "Om", "Ok", "Kn", "ObS", "ObN", "Ks", "LkW", "LkE", "Le", "Li"]
+syllables = ["ha", "ki", "la", "nen", "ko", "ski", "vaa", "ra", "jär", "vi", "lah", "ti", "pel", "to", "mä", "sa", "lo", "ny", "by", "berg"]
+# Name endings and the abbreviations used for them in specimen files (expanded by the replacement rules)
+abbreviations = [ (" maalaiskunta", [" mlk", " mlk."]), (" pitäjä", [" pit", " pit."]),
+    (" landskommun", [" lk", " lk."]), (" socken", [" sn", " sn."]) ]
+
+name_tries = 200 # Random syllable names tried before numbering the name
+name_combinations = sum( len(syllables)**k for k in (2, 3, 4) )
+
+def _name(rng, used):
+    """A name not in used. When the syllable names run out (large known data files) the
+    name gets the number of names so far, which is unique."""
+    for i in range(name_tries if len(used) < name_combinations else 1):
+        name = "".join(rng.choice(syllables) for i in range(rng.randint(2, 4))).capitalize()
+        if name not in used: break
+    else: name += " %d" % len(used)
+    used.add(name)
+    return name
+
+def make_places(nrows, rng):
+    """Return nrows distinct places as dicts of rule column values ('*' = any) and output values."""
+    used = set()
+    places = []
+    municipalities = []
+    while len(places) < nrows:
+        r = rng.random()
+        if r < 0.3 or not municipalities: # Municipality, any locality
+            name = _name(rng, used)
+            x = rng.random()
+            if x < 0.15: name += rng.choice(abbreviations)[0]
+            elif x < 0.2: name = "S:t " + name
+            municipalities.append(name)
+            place = { 'munic': name, 'locality': "*", 'province': rng.choice(provinces) }
+        elif r < 0.9: # Locality in a municipality
+            place = { 'munic': rng.choice(municipalities), 'locality': _name(rng, used), 'province': "*" }
+        else: # Locality known by biological province only
+            place = { 'munic': "*", 'locality': _name(rng, used), 'province': rng.choice(provinces) }
+        place['dates'] = ("*", "*")
+        if rng.random() < 0.05: # Same place, different periods (e.g. municipality mergers)
+            place['dates'] = ("*", "31.12.1944")
+            places.append(dict(place, dates=("1.1.1945", "*")))
+        places.append(place)
+        if rng.random() < 0.02: places.append(dict(place)) # Same place twice, gives multiple matches
+    return places[:nrows]
+
+def make_gazetteer(fn, places, rng):
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("locdata")
+    ws.append([ name for (name, rule) in gazetteer_columns ])
+    ws.append([ rule for (name, rule) in gazetteer_columns ])
+    ws.append([ "reserved" ]*len(gazetteer_columns))
+    ws.append([ "reserved" ]*len(gazetteer_columns)) # GeoData reads data after the first 4 rows
+    for (n, p) in enumerate(places):
+        lat = round(rng.uniform(59.8, 70.0), 5)
+        lon = round(rng.uniform(20.5, 31.5), 5)
+        ws.append([ n+1, "Finland", "*", p['province'], p['munic'], p['locality'], "*", p['dates'][0], p['dates'][1],
+            "", "Finland", "Europe", p['province'] if p['province'] != "*" else "", p['munic'] if p['munic'] != "*" else "",
+            lat, lon, rng.choice([100, 1000, 5000]), "wgs84", "synthetic", "Synthetic georeference" ])
+    wb.save(fn)
+
+def _variant(value, rng):
+    """A value as it could be written in a specimen file: abbreviated, different case or spacing."""
+    if value == "*": return ""
+    r = rng.random()
+    for (ending, abbrs) in abbreviations:
+        if value.endswith(ending) and r < 0.7: return value[:-len(ending)] + rng.choice(abbrs)
+    if value.startswith("S:t ") and r < 0.5: return "St. " + value[4:]
+    if r < 0.1: return value.upper()
+    if r < 0.2: return value.replace(" ", "  ") + " "
+    return value
+
+def make_specimens(fn, nrows, places, rng):
+    """Specimen file of nrows rows. Specimens come in series from one gathering (same place and
+    date written the same way), places are picked with a Zipf-like distribution so that a few
+    localities are very common. Some rows have no known place, some have coordinates already."""
+    weights = [ 1.0/(rank+1)**1.1 for rank in range(len(places)) ]
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Specimens")
+    ws.append(specimen_columns)
+    ws.append([ "" ]*len(specimen_columns)) # Second header row of Kotka exports
+    n = 0
+    while n < nrows:
+        p = rng.choices(places, weights)[0]
+        munic = _variant(p['munic'], rng)
+        locality = _variant(p['locality'], rng)
+        r = rng.random()
+        if r < 0.1: locality = "Unknown place %d" % rng.randint(1, 1000) # No match
+        year = rng.randint(1850, 2020)
+        if p['dates'][0] != "*": year = rng.randint(1945, 2020)
+        elif p['dates'][1] != "*": year = rng.randint(1850, 1944)
+        date = rng.choice([ f"{rng.randint(1,28)}.{rng.randint(1,12)}.{year}", str(year), f"{rng.randint(1,12)}.{year}" ])
+        province = p['province'] if (p['province'] != "*" and rng.random() < 0.5) else ""
+        coords = ("60.1", "24.9") if r > 0.95 else ("", "") # Skipped, has coordinates already
+        for i in range(min(int(rng.expovariate(0.25)) + 1, nrows - n)):
+            ws.append([ "Finland", "", province, munic, locality, "", date, "http://id.luomus.fi/", f"GV.{n}",
+                "Aus bus", "(Linnaeus, 1758)", "Collector, A.", coords[0], coords[1], "", "", "", "", "PreservedSpecimen", "1" ])
+            n += 1
+    wb.save(fn)
+
+class Timer():
+    """Collects the time of each stage."""
+    def __init__(self): self.stages = {}
+    def __call__(self, name):
+        self._name = name
+        return self
+    def __enter__(self): self._start = time.perf_counter()
+    def __exit__(self, *exc): self.stages[self._name] = self.stages.get(self._name, 0.0) + time.perf_counter() - self._start
+
+def run(size, ninput, settings, workdir, rng, seed):
+    """Generate the files for one size and time the stages, return the result as a dict."""
+    timer = Timer()
+    gazfn = workdir / f"synthetic_gazetteer_{size}_{seed}.xlsx"
+    specfn = workdir / f"synthetic_specimens_{ninput}_{size}_{seed}.xlsx"
+    with timer("generate"):
+        places = make_places(size, rng)
+        if not gazfn.exists(): make_gazetteer(gazfn, places, rng)
+        if not specfn.exists(): make_specimens(specfn, ninput, places, rng)
+    for fn in [gazfn, specfn]:
+        cachefn = jksheet.GeoData.cachefile_for(fn)
+        if cachefn.exists(): cachefn.unlink()
+
+    with timer("load"):
+        gd = jksheet.GeoData.fromfile(gazfn, None, paikkain.first_data_line_of_geodata)
+    assert gd.ndatarows == len(places), f"{gazfn}: {gd.ndatarows} data rows loaded, {len(places)} places"
+    with timer("parse_rules"):
+        plan = gd.parse_rules(known_test_types)
+    cache_settings = (settings.ignorechars, tuple(settings.regular_subs.items()))
+    jksheet.GeoData.fromfile(gazfn, None, paikkain.first_data_line_of_geodata, use_cache=True, cache_settings=cache_settings).update_cache()
+    with timer("load_cached"):
+        jksheet.GeoData.fromfile(gazfn, None, paikkain.first_data_line_of_geodata, use_cache=True, cache_settings=cache_settings)
+
+    with timer("read"):
+        indata = jksheet.roExcel(specfn, settings.first_data_line)
+        firstrow = indata.next_row()
+        rows = list(paikkain.read_rows(indata))
+        indata.close()
+    tomatch = [ origdict for (rowcount, origdict) in rows if not paikkain.skip_row(origdict, rowcount, settings) ]
+
+    normalizer = jktools.Normalizer(settings.ignorechars, settings.regular_subs)
+    with timer("normalise"):
+        normalized = [ normalizer.normalize_dict(d, plan.colnames) for d in tomatch ]
+    with timer("find_matches"):
+        found = [ gd.find_normalized_matches(nd, plan) for nd in normalized ]
+
+    geodataset = jksheet.GeoDataSet([gd], known_test_types, "cascade", settings.knownd_cachesize)
+    normalizer = jktools.Normalizer(settings.ignorechars, settings.regular_subs) # Empty cache
+    with timer("find_matches_cached"): # Normalisation included
+        matches = [ geodataset.find_matches(d, normalizer) for d in tomatch ]
+    try:
+        geodataset.prepare_batch()
+        with timer("find_matches_batch"): # Normalisation included
+            batchmatches = geodataset.find_matches_batch(tomatch, jktools.Normalizer(settings.ignorechars, settings.regular_subs))
+        if batchmatches != matches: log.error("Batch engine results differ from find_matches()")
+    except jksheet.jkError as err: log.info(f"Batch engine not benchmarked: {err}")
+
+    outfn = workdir / f"synthetic_output_{ninput}_{size}_{seed}.xlsx"
+    if outfn.exists(): outfn.unlink()
+    outdata = jksheet.woExcel(outfn, settings.first_data_line)
+    outdata.fill_edited_color("fa867e")
+    paikkain.add_output_columns(outdata, firstrow, geodataset, settings)
+    outcolnames = frozenset(outdata.lowercolnames)
+    found = iter(matches)
+    with timer("apply"):
+        results = [ paikkain.process_row(origdict, rowcount, outcolnames, geodataset, normalizer, settings,
+            None if paikkain.skip_row(origdict, rowcount, settings) else next(found)) for (rowcount, origdict) in rows ]
+    with timer("write"):
+        for (outdict, edited) in results:
+            outdata.itersetrow(outdict, edited)
+            next(outdata)
+        outdata.close()
+
+    nmatches = [ len(m) for m in matches ]
+    counts = { 'input_rows': len(rows), 'skipped': len(rows) - len(tomatch), 'no_match': nmatches.count(0),
+        'unique_match': nmatches.count(1), 'multiple_matches': len(nmatches) - nmatches.count(0) - nmatches.count(1),
+        'cache_hits': geodataset.cache.hits, 'cache_misses': geodataset.cache.misses }
+    stages = { k: round(v, 4) for (k, v) in timer.stages.items() }
+    perrow = { 'read': len(rows), 'normalise': len(tomatch), 'find_matches': len(tomatch), 'find_matches_cached': len(tomatch),
+        'find_matches_batch': len(tomatch), 'apply': len(rows), 'write': len(rows) }
+    rates = { k: round(n / timer.stages[k], 1) for (k, n) in perrow.items() if timer.stages.get(k) }
+    return { 'gazetteer_rows': size, 'input_rows': ninput, 'seed': seed, 'stages': stages, 'rows_per_second': rates, 'counts': counts }
+
+def _git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+            cwd=Path(__file__).parent, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError): return None
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='Benchmark paikkain with synthetic known data and specimen files')
+    ap.add_argument('--sizes', default="1000,10000", help='known data sizes (rows), comma separated (default 1000,10000)')
+    ap.add_argument('--input-rows', type=int, default=None, help='rows in the specimen files (default: same as known data size)')
+    ap.add_argument('--config', default=str(Path(__file__).parent.parent / "config" / "paikkain_finland.toml"),
+        help='config file for the settings, known data file names are not used (default paikkain_finland.toml)')
+    ap.add_argument('--workdir', default=None, help='directory for the generated files, kept for later runs (default: temporary directory)')
+    ap.add_argument('--results', default="benchmark_results.jsonl", help='results file, one JSON object per line is appended (default benchmark_results.jsonl)')
+    ap.add_argument('--seed', type=int, default=1, help='random seed for the generated data (default 1)')
+    args = ap.parse_args()
+
+    logging.basicConfig(format='%(message)s [%(levelname)s]', level=logging.WARNING)
+    log.setLevel(logging.WARNING) # Row level messages would be timed as well
+    paikkain.log = log
+    settings = paikkain.read_settings(paikkain.read_TOML_config(Path(args.config)))
+    sizes = [ int(x) for x in args.sizes.split(",") ]
+    tmpdir = None
+    if args.workdir: workdir = Path(args.workdir)
+    else:
+        tmpdir = tempfile.TemporaryDirectory()
+        workdir = Path(tmpdir.name)
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    header = { 'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), 'version': paikkain.version,
+        'git': _git_version(), 'python': platform.python_version(), 'platform': platform.platform(),
+        'openpyxl': openpyxl.__version__, 'config': Path(args.config).name }
+    with open(args.results, "a", encoding="utf-8") as resultfile:
+        for size in sizes:
+            result = dict(header, **run(size, args.input_rows or size, settings, workdir, random.Random(args.seed), args.seed))
+            resultfile.write(json.dumps(result) + "\n")
+            resultfile.flush()
+            print(f"Known data {size} rows, input {result['input_rows']} rows:")
+            for (stage, seconds) in result['stages'].items():
+                rate = result['rows_per_second'].get(stage)
+                print(f"  {stage:22s} {seconds:9.3f} s" + (f" {rate:12.0f} rows/s" if rate else ""))
+            print("  " + ", ".join(f"{k} {v}" for (k, v) in result['counts'].items()))
+    print(f"Results appended to {args.results}")
+    if tmpdir: tmpdir.cleanup()
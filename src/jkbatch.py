@@ -0,0 +1,154 @@
+# Vectorised matching of many input rows at once. Needs NumPy and pandas, which are only
+# imported when the batch engine is selected (match_engine = "batch" in the config file).
+import numpy as np
+import pandas as pd
+import logging, time
+import jktest
+from jktest import datebefore,  dateafter
+
+progname = 'paikkain'
+log = logging.getLogger(progname)
+
+_wildcard = -1 # Code of '*' in 'equal' columns of the known data
+_unknown = -2 # Code of user values not found in an 'equal' column of the known data
+
+class BatchPlan():
+    """A jktest.RulePlan as NumPy arrays, for matching a batch of input rows at once.
+
+    Values of 'equal' columns are coded as integers and dates as day numbers. Candidate rows
+    are found by joining the distinct input values with the known data on the index rules
+    (see jktest.MatchIndex), then all rules are tested for all (input, candidate row) pairs
+    with boolean masks. match_rows() gives the same results as RulePlan.match_rows() for each row."""
+    ruletimes = None # [tests, seconds] for each rule between start_timing() and stop_timing()
+
+    def __init__(self, rules, columns):
+        self.rules = tuple(rules)
+        self.nrows = len(columns[0]) if columns else 0
+        self._tests = [] # (rule, geodata arrays, codes of values for 'equal' rules)
+        for rule in self.rules:
+            prepared = [ rule.prepare(v) for v in columns[rule.col] ]
+            arrays = { 'wild': np.array([ v is None for v in prepared ], dtype=bool) }
+            codes = None
+            if rule.type == "equal":
+                codes = {}
+                arrays['code'] = np.array([ _wildcard if v is None else codes.setdefault(v, len(codes)) for v in prepared ], dtype=np.int64)
+            elif rule.type in [datebefore,  dateafter]:
+                values = [ v or ("", None) for v in prepared ]
+                arrays['values'] = values # For log messages
+                (arrays['empty'], arrays['bad'], arrays['day']) = _datearrays(values)
+            self._tests.append( (rule, arrays, codes) )
+        # Known data rows grouped by which index rules have a real value (not '*'), as in MatchIndex
+        keyrules = jktest.index_rules(self.rules)
+        self._keypos = [ i for (i, (rule, arrays, codes)) in enumerate(self._tests) if any(rule is k for k in keyrules) ]
+        self._groups = [] # (index rule positions, DataFrame of their codes and row numbers)
+        self.evaluations = 0 # Rule tests done by match_rows(), for statistics
+        if not self.nrows: return
+        keycodes = np.column_stack([ self._tests[i][1]['code'] for i in self._keypos ]) if self._keypos else np.zeros((self.nrows, 0), dtype=np.int64)
+        masks = keycodes != _wildcard
+        if self._keypos: (groupmasks, groupof) = np.unique(masks, axis=0, return_inverse=True)
+        else: (groupmasks, groupof) = (np.zeros((1, 0), dtype=bool), np.zeros(self.nrows, dtype=np.int64))
+        groupof = groupof.reshape(-1)
+        for (g, mask) in enumerate(groupmasks):
+            rows = np.nonzero(groupof == g)[0]
+            keycols = np.nonzero(mask)[0]
+            frame = pd.DataFrame({ f"k{c}": keycodes[rows, c] for c in keycols })
+            frame['row'] = rows
+            self._groups.append( ([ f"k{c}" for c in keycols ], frame) )
+
+    def start_timing(self):
+        """Count and time the tests of each rule (for profiling), as RulePlan.start_timing()."""
+        if self.ruletimes is None: self.ruletimes = [ [0, 0.0] for rule in self.rules ]
+
+    def stop_timing(self):
+        """Return a list of (rule, tests, seconds) since start_timing()."""
+        if self.ruletimes is None: return []
+        (times, self.ruletimes) = (self.ruletimes, None)
+        return [ (rule, tests, seconds) for (rule, (tests, seconds)) in zip(self.rules, times) ]
+
+    def match_rows(self, userrows):
+        """Return, for each row (dict of normalized values) in userrows, a list of zero-based indices of matching rows."""
+        # Rows with the same values in the rule columns have the same matches
+        keys = {}
+        keyof = [ keys.setdefault(tuple(rule.prepare_user(d) for rule in self.rules), len(keys)) for d in userrows ]
+        if not keys or not self.nrows: return [ [] for k in keyof ]
+        keys = list(keys)
+        nkeys = len(keys)
+        user = [] # Arrays of the user values of each rule, by key
+        for (i, (rule, arrays, codes)) in enumerate(self._tests):
+            values = [ k[i] for k in keys ]
+            if rule.type == "equal": user.append( np.array([ codes.get(v, _unknown) for v in values ], dtype=np.int64) )
+            elif rule.type == "notempty": user.append( np.array([ not v for v in values ], dtype=bool) )
+            else: user.append( _datearrays(values) )
+
+        # Candidate (key, row) pairs: join on the index rules, ordered by key and row
+        userframe = pd.DataFrame({ f"k{n}": user[i] for (n, i) in enumerate(self._keypos) })
+        userframe['key'] = np.arange(nkeys)
+        pairs = []
+        for (keycols, frame) in self._groups:
+            if keycols: joined = userframe[ ['key'] + keycols ].merge(frame, on=keycols)
+            else: joined = userframe[ ['key'] ].merge(frame[ ['row'] ], how='cross')
+            pairs.append( joined[ ['key', 'row'] ] )
+        pairs = pd.concat(pairs)
+        key = pairs['key'].to_numpy()
+        row = pairs['row'].to_numpy()
+        order = np.lexsort((row, key))
+        (key, row) = (key[order], row[order])
+
+        # Test the rules in order, as RulePlan.match_rows(): the first failing rule decides
+        # whether the row just fails (2) or stops the search (untestable date)
+        passing = np.ones(len(key), dtype=bool) # No rule failed so far
+        tested = np.zeros(len(key), dtype=bool) # At least one real test succeeded
+        stopped = np.zeros(len(key), dtype=bool)
+        stoprule = np.zeros(len(key), dtype=np.int64)
+        for (i, (rule, arrays, codes)) in enumerate(self._tests):
+            start = time.perf_counter()
+            real = ~arrays['wild'][row] # '*' = no test
+            if rule.type == "equal":
+                same = arrays['code'][row] == user[i][key]
+                (success, fail) = (real & same, real & ~same)
+            elif rule.type == "notempty":
+                userempty = user[i][key]
+                (success, fail) = (real & ~userempty, real & userempty)
+            else:
+                (userempty, userbad, userday) = (a[key] for a in user[i])
+                (geoempty, geobad, geoday) = (arrays['empty'][row], arrays['bad'][row], arrays['day'][row])
+                datetest = ~userempty & ~geoempty
+                untestable = real & datetest & (userbad | geobad)
+                datetest &= ~(userbad | geobad)
+                inorder = userday <= geoday if rule.type == datebefore else userday >= geoday
+                success = real & ( (userempty & geoempty) | (datetest & inorder) )
+                fail = real & ( (userempty != geoempty) | (datetest & ~inorder) )
+                newstops = passing & untestable
+                stopped |= newstops
+                stoprule[newstops] = i
+                passing &= ~untestable
+            passing &= ~fail
+            tested |= success
+            if self.ruletimes is not None:
+                self.ruletimes[i][0] += len(key)
+                self.ruletimes[i][1] += time.perf_counter() - start
+
+        # Rows from the first untestable row on are not searched
+        cutoff = np.full(nkeys, self.nrows)
+        stops = np.nonzero(stopped)[0]
+        if len(stops):
+            (stopkeys, first) = np.unique(key[stops], return_index=True)
+            cutoff[stopkeys] = row[stops][first]
+            stopat = { k: stops[f] for (k, f) in zip(stopkeys.tolist(), first.tolist()) }
+            for k in keyof: # Log as RulePlan does, once for each input row
+                if k in stopat:
+                    (n, i) = (stopat[k], stoprule[stopat[k]])
+                    log.info(f"Failed to convert '{keys[k][i][0]}' or '{self._tests[i][1]['values'][row[n]][0]}' to a Date: Date format not recognised" )
+        self.evaluations += len(key) * len(self._tests) # All rules are tested for all candidates
+        found = passing & tested & (row < cutoff[key])
+        (foundkeys, foundrows) = (key[found], row[found])
+        bounds = np.searchsorted(foundkeys, np.arange(nkeys + 1))
+        bykey = [ foundrows[bounds[k]:bounds[k+1]].tolist() for k in range(nkeys) ]
+        return [ bykey[k] for k in keyof ]
+
+def _datearrays(values):
+    """(empty, not recognised, day number) arrays of prepared (value, date) pairs."""
+    empty = np.array([ not val for (val, date) in values ], dtype=bool)
+    bad = np.array([ bool(val) and date is None for (val, date) in values ], dtype=bool)
+    day = np.array([ date.toordinal() if date else 0 for (val, date) in values ], dtype=np.int64)
+    return (empty, bad, day)
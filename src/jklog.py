@@ -0,0 +1,72 @@
+# Logging off the processing loop: log records are queued to a thread that writes them to the
+# log file and the console in batches, flushing once per batch. Per-row information goes to a
+# separate logger, written as JSON lines to a side file (RowLog).
+import logging, logging.handlers, queue, threading, json
+
+batch_records = 500 # Records written between flushes at most
+
+class _Batched():
+    """For stream handlers written by BackgroundLogging: the messages of a batch are collected and
+    written to the stream at once by flush(), which is called after each batch."""
+    def __init__(self, *args, **kwargs):
+        self._batch = []
+        super().__init__(*args, **kwargs)
+    def emit(self, record):
+        try: self._batch.append(self.format(record) + self.terminator)
+        except Exception: self.handleError(record)
+    def flush(self):
+        self.acquire()
+        try:
+            if self._batch and self.stream:
+                self.stream.write("".join(self._batch))
+                self._batch = []
+            super().flush()
+        finally: self.release()
+
+class FileHandler(_Batched, logging.FileHandler): pass
+class StreamHandler(_Batched, logging.StreamHandler): pass
+
+class BackgroundLogging():
+    """Passes the records of logger through a queue to a thread that writes them with handlers
+    (FileHandler and StreamHandler of this module). stop() writes the records left and
+    attaches the handlers to the logger directly, after that they are written at exit."""
+    def __init__(self, logger, handlers):
+        self.logger = logger
+        self.handlers = handlers
+        self.records = queue.SimpleQueue()
+        self.queuehandler = logging.handlers.QueueHandler(self.records)
+        logger.addHandler(self.queuehandler)
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _write(self):
+        while True:
+            batch = [self.records.get()]
+            while len(batch) < batch_records:
+                try: batch.append(self.records.get_nowait())
+                except queue.Empty: break
+            for record in batch:
+                if record is None: break
+                for h in self.handlers:
+                    if record.levelno >= h.level: h.handle(record)
+            for h in self.handlers: h.flush()
+            if record is None: return
+
+    def stop(self):
+        if not self._thread.is_alive(): return
+        self.records.put(None)
+        self._thread.join()
+        self.logger.removeHandler(self.queuehandler)
+        for h in self.handlers: self.logger.addHandler(h)
+
+class RowLog(logging.Handler):
+    """Writes the row data of the records (record.row, a dict) to a file as JSON lines.
+    Writes are buffered by the file, not flushed for each row."""
+    def __init__(self, filename):
+        super().__init__()
+        self.f = open(filename, "w", encoding="utf-8")
+    def emit(self, record):
+        self.f.write(json.dumps(record.row, ensure_ascii=False, separators=(",", ":")) + "\n")
+    def close(self):
+        self.f.close()
+        super().close()
@@ -1,20 +1,34 @@
 # A wrapper around spreadsheet-like files (or other similar objects)
-import openpyxl     
-import jktest,  jktools
+# openpyxl is imported when the first Excel file is opened, runs with CSV files only do without it.
+import jktest,  jktools,  jksuggest,  jkspatial
 from jkerror import jkError
-import csv, logging, abc
+import csv, logging, abc, sys, os, pickle, time, collections
 from pathlib import Path
 
 progname = 'paikkain'
 log = logging.getLogger(progname)
 
-editedFill = openpyxl.styles.PatternFill(start_color="fa867e", end_color= "fa867e", fill_type='solid')
-
 #Could be used to format cells depending on the operation type
 op_replaced = 1
 op_appended = 2
 validops = [op_replaced, op_appended]
 
+def _openpyxl(): return jktools.timed_import("openpyxl")
+
+def iter_sheet_values(sheet):
+    """Rows of a read-only sheet as tuples of values, in the order of sheet.values of a fully loaded sheet. 
+
+    Rows are only as long as their last cell. Rows without cells at the end of the sheet are
+    not included: some exports contain row elements up to row 1048576."""
+    emptyrows = 0 
+    for row in sheet.iter_rows(values_only=True):
+        if not row: 
+            emptyrows += 1
+            continue
+        for n in range(emptyrows): yield ()
+        emptyrows = 0
+        yield tuple(row)
+
 class jkExcel(abc.ABC):
     """First row, first col = 1"""
     def __init__(self,filename,first_data_line_number):     
@@ -60,106 +74,320 @@ class jkExcel(abc.ABC):
 
 # --------------------------- OUTPUT FILES ---------------------------
 class woExcel(jkExcel):
-    """First row, first col = 1"""    
+    """Excel output written row by row through a write-only workbook. First row, first col = 1
+
+    Columns are added first. The header and the column positions are fixed when the 
+    first row is written, after that no columns can be added."""    
     supports_fill = True
     def __init__(self,filename,first_data_line):     
         self.fill_edited= None
+        self._header = [] # Header rows for each column, in column order (None = empty column)
+        self._lowernames = set()
+        self._colpos = None # Column name -> zero-based position, set when writing starts
+        self._rowswritten = 0
         super().__init__(filename,first_data_line)
     def _openwb(self): 
-        # Create a new workbook
-        wb = openpyxl.Workbook()
-        self.sheet = wb.create_sheet()
+        # Create a new workbook. Data goes to the first sheet, the second one is left empty as before.
+        wb = _openpyxl().Workbook(write_only=True)
+        wb.create_sheet("Sheet")
+        wb.create_sheet("Sheet1")
         return wb
+    # Can be sent to another process (the pipeline writer) before rows are written: the workbook is created again there
+    def __getstate__(self):
+        if self._colpos is not None: raise jkError(f"{self.fp}: cannot copy output after writing rows")
+        state = self.__dict__.copy()
+        del state["wb"], state["sheet"]
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.wb = self._openwb()
+        self.sheet = self.wb.active
     # PROPERTY ATTRIBUTES
+    @property
+    def nrows(self): return self._rowswritten
+    @property
+    def ncols(self): return len(self._header)
+    @property
+    def colnames(self): return [h[0] for h in self._header if h]
+    @property
+    def lowercolnames(self): return [h[0].lower() for h in self._header if h]
+    def hascolumn(self,colname, casesensitive=False): 
+        if casesensitive: return colname in self.colnames
+        else: return colname.lower() in self._lowernames
     def fill_edited_color(self, color):
-        self.fill_edited = openpyxl.styles.PatternFill(start_color=color, end_color= color, fill_type='solid')
+        self.fill_edited = _openpyxl().styles.PatternFill(start_color=color, end_color= color, fill_type='solid')
     # FILE CONTENT MODIFICATION
-    def save(self): self.wb.save(str(self.fp))
+    def save(self): 
+        if self._colpos is None: self._startwriting() # Header only
+        self.wb.save(str(self.fp))
+    def close(self): 
+        if self.wb: self.save()
+        self.wb = None
+    def discard(self):
+        """Drop the output (processing failed): close the rows being written and remove the 
+        temporary files of the write-only sheets, instead of leaving them to garbage collection."""
+        if not self.wb: return
+        for ws in self.wb.worksheets:
+            if ws._rows: ws._rows.close()
+            if ws._writer:
+                ws._writer.close()
+                ws._writer.cleanup()
+        self.wb = None
     def addcolumn(self,position,header_rows=["New column"]):
         """Add column. Note: First column is 1 etc."""
+        if self._colpos is not None: raise jkError(f"{self.fp}: cannot add columns after writing rows")
         if not header_rows[0] or not header_rows[0].strip(): 
             raise ValueError(f"Missing of empty column names are not allowed.")
-        if header_rows[0].lower() in self._lowern2col: 
+        if header_rows[0].lower() in self._lowernames: 
             raise ValueError(f"Column name {header_rows[0]} does already exist")
-        self.sheet.insert_cols(position) 
-        for ii in range(len(header_rows)):  
-            self._setcell(position,1+ii,header_rows[ii])
-        self._update_name2column() 
-    def _setcell(self,colno,rowno,value): # Get value
-        self.sheet.cell(column=colno,row=rowno).value = value
-    def _setncell(self,colname,rowno,value): # Get value by column name
-        colno = self._lowern2col[colname.lower()]    
-        self._setcell(colno,rowno,value)
-    def iterset(self,colno,value): self._setncell(colno,self.crow,value)
-    def iternset(self,colname,value): self._setncell(colname,self.crow,value)
+        if position > len(self._header): # Empty columns up to position
+            self._header.extend([None]*(position - 1 - len(self._header)))
+        self._header.insert(position-1, list(header_rows))
+        self._lowernames.add(header_rows[0].lower())
+    def _startwriting(self):
+        """Write the header rows, fix column positions and create the cell styles shared by all rows."""
+        nheaderrows = max((len(h) for h in self._header if h), default=0)
+        for ii in range(nheaderrows):
+            self.sheet.append([ (h[ii] if h and ii < len(h) else None) for h in self._header ])
+            self._rowswritten += 1
+        self._colpos = {}
+        for (pos, h) in enumerate(self._header):
+            if h: 
+                self._colpos[h[0]] = pos
+                self._colpos[h[0].lower()] = pos
+        # One styled cell per column and style, reused for every row: the write-only sheet
+        # writes a row out when it is appended. Cells are text, edited cells also get a fill.
+        openpyxl = _openpyxl()
+        textcell = openpyxl.cell.WriteOnlyCell(self.sheet)
+        textcell.number_format = '@' # TEXT
+        self._textcells = [ openpyxl.cell.Cell(self.sheet, row=1, column=1, style_array=textcell._style) 
+            for h in self._header ]
+        self._editedcells = None
+        if self.fill_edited:
+            editedcell = openpyxl.cell.WriteOnlyCell(self.sheet)
+            editedcell.number_format = '@' 
+            editedcell.fill = self.fill_edited
+            self._editedcells = [ openpyxl.cell.Cell(self.sheet, row=1, column=1, style_array=editedcell._style) 
+                for h in self._header ]
     def itersetrow(self, dict_column_and_value,  edited):
         """Create a new row from a dctionary with column names as keys
     
     The keyword edited, of provided, must be an array of len(dict_column_and_value), with values controlling cell formatting. 0 for no formatting, 
     True values (like non-zero)  integer do currently result in cess color
         """
-        cellrow = [None]*len(self.colnames)
-#        print("len cellrow = ",  len(cellrow))
-        for colname in dict_column_and_value:       
-            pos = self._lowern2col[colname.lower()] -1
-#            print(pos, colname)
-            cell = openpyxl.cell.WriteOnlyCell(self.sheet, value= dict_column_and_value[colname])
-            cell.number_format = '@' # TEXT
-            if edited and edited[colname] and self.fill_edited: cell.fill = self.fill_edited
+        if self._colpos is None: self._startwriting()
+        colpos = self._colpos
+        textcells = self._textcells
+        editedcells = self._editedcells if edited else None
+        cellrow = [None]*len(self._header)
+        for (colname, value) in dict_column_and_value.items():       
+            pos = colpos.get(colname)
+            if pos is None: pos = colpos[colname.lower()]
+            cell = editedcells[pos] if (editedcells and edited[colname]) else textcells[pos]
+            cell.value = value
             cellrow[pos] = cell
         self.sheet.append(cellrow)    
+        self._rowswritten += 1
 
 
 # --------------------------- INPUT FILES, READ ONLY ---------------------------
-class roExcel(jkExcel):
+class _RowStream():
+    """Row by row reading, shared by the streaming readers. 
+    
+    _openwb() should call _startrows() with an iterator over the rows of the file as tuples."""
     supports_fill = False
+    def _startrows(self, rows):
+        self._header = ()
+        self.rows = self._iterrows(rows) # Iterator!
+        self._nextrow = next(self.rows, None) # One row lookahead for end(), None at end of sheet
+        self._header = self._nextrow or ()
+    def _iterrows(self, rows):
+        for (n, row) in enumerate(rows, 1):
+            # Pad to full width of the header
+            if len(row) < len(self._header): row += (None,)*(len(self._header) - len(row))
+            elif self._header and len(row) > len(self._header):
+                # Data past the last column name would be lost
+                extra = [ i for (i, v) in enumerate(row) if i >= len(self._header) and v not in (None, "") ]
+                if extra: raise ValueError(f"File {self.fp}, column {extra[0]+1}: Empty column name (first row) not allowed (data on row {n}).")
+                row = row[:len(self._header)]
+            yield row
+    def _update_name2column(self):
+        _cotitles = self._header
+        _ind = tuple(range(1,len(_cotitles)+1))
+        self._name2col = { c:i for (c,i) in zip(_cotitles,_ind) if c}
+        self._lowern2col = { c.lower():i for (c,i) in zip(_cotitles,_ind) if c}
+    def end(self): return self._nextrow is None
+    def next_row(self):
+        row = self._nextrow
+        if row is None: raise StopIteration
+        self._nextrow = next(self.rows, None)
+        self.next()
+        return row
+    def _row2dict(self,row):
+        return { k:(v or "") for (k,v) in zip(self.lowercolnames,row) }
+    def next_row_as_dict(self):
+        return self._row2dict(self.next_row())
+
+class roExcel(_RowStream, jkExcel):
+    """Streaming reader: rows are read one at a time from a read-only workbook,
+    so memory use does not depend on the size of the sheet."""
     def __init__(self,filename,first_data_line):     
         super().__init__(filename,first_data_line)
         self._update_name2column()
     def _openwb(self): 
-        wb = openpyxl.load_workbook(self.fp) #, read_only=True
-        self.rows = wb.active.values # Iterator!
+        wb = _openpyxl().load_workbook(self.fp, read_only=True)
+        wb.active.reset_dimensions() # Do not trust the size stored in the file, read all rows
+        self._startrows(iter_sheet_values(wb.active))
         return wb
+    def close(self): 
+        if self.wb: self.wb.close() # Read-only: nothing to save
 #    def set_active_sheet(self,n): # Zero-based indexing
 #        wb.active = n        #Should reset Next counter
 #        self.sheet = self.wb.active
-    def next_row(self):
-        self.next()
-        return next(self.rows)
-    def _row2dict(self,row):
-        return { k:(v or "") for (k,v) in zip(self.lowercolnames,row) }
-    def next_row_as_dict(self):
-        row = next(self.rows)
-        self.next()
-        return self._row2dict(row)
-    def get_row(self,n):# Direct row access, 1-based indexing
-        return [ x.value for x in self.sheet[n] ]
-    def get_value(self,nrow,ncol):# Direct cell access, 1-based indexing
-        return self.sheet.cell(row=nrow, column=ncol).value
-    def get_row_as_dict(self,nrow):
-        return self._row2dict( self.get_row(nrow) )
+
+# --------------------------- CSV FILES ---------------------------
+csv_suffixes = [".csv", ".tsv", ".txt"] # Input files read with roCSV
+
+class jkCSV(jkExcel):
+    """CSV file with the same interface as the Excel classes. Rows are read or written one at a time.
+
+    dialect is a csv module dialect name ("excel", "excel-tab", "unix"), other keyword 
+    arguments are csv format parameters (e.g. delimiter=";")."""
+    def __init__(self, filename, first_data_line, encoding="utf-8-sig", dialect="excel", **fmtparams):
+        self.fp = Path(filename)
+        self._name2col = {} 
+        self._lowern2col = {} # Should use lowercase column names
+        self.crow = 1 # Current row
+        self.first_data_line = first_data_line
+        self.encoding = encoding
+        self.dialect = dialect
+        self.fmtparams = fmtparams
+        self.sheet = None
+        self.wb = self._openwb() # The open file
+    @property
+    def nrows(self): return self.crow - 1 # Rows read or written so far
+    @property
+    def ncols(self): return len(self._name2col)
+    def close(self): 
+        if self.wb: self.wb.close()
+        self.wb = None
+
+class roCSV(_RowStream, jkCSV):
+    """Streaming CSV reader, first row has the column names."""
+    def __init__(self, filename, first_data_line, **csvoptions):     
+        super().__init__(filename, first_data_line, **csvoptions)
+        self._update_name2column()
+    def _openwb(self): 
+        f = open(self.fp, newline="", encoding=self.encoding)
+        self._startrows( tuple(row) for row in csv.reader(f, self.dialect, **self.fmtparams) )
+        return f
+
+class woCSV(jkCSV):
+    """Streaming CSV writer. Columns can be added until the first row is written. 
+    
+    Output goes to a temporary file that replaces the output file on close(). Cell formatting 
+    is not supported, only the first header row is written."""
+    supports_fill = False
+    def _openwb(self): 
+        self._tmpfn = self.fp.with_name(self.fp.name + ".tmp")
+        self._header = [] # Column names in order
+        self.writer = None # Created when the first row is written
+        return None
+    def _update_name2column(self):
+        _ind = tuple(range(1,len(self._header)+1))
+        self._name2col = { c:i for (c,i) in zip(self._header,_ind) }
+        self._lowern2col = { c.lower():i for (c,i) in zip(self._header,_ind) }
+    def fill_edited_color(self, color): pass 
+    def addcolumn(self,position,header_rows=["New column"]):
+        """Add column. Note: First column is 1 etc."""
+        if self.writer: raise jkError(f"{self.fp}: cannot add columns after writing rows")
+        if not header_rows[0] or not header_rows[0].strip(): 
+            raise ValueError(f"Missing of empty column names are not allowed.")
+        if header_rows[0].lower() in self._lowern2col: 
+            raise ValueError(f"Column name {header_rows[0]} does already exist")
+        self._header.insert(position-1, header_rows[0])
+        self._update_name2column() 
+    def _startwriting(self):
+        self.wb = open(self._tmpfn, "w", newline="", encoding=self.encoding)
+        self.writer = csv.writer(self.wb, self.dialect, **self.fmtparams)
+        self.writer.writerow(self._header)
+    def itersetrow(self, dict_column_and_value,  edited=None):
+        """Write a row from a dictionary with column names as keys. edited is ignored (no formatting in CSV)."""
+        if not self.writer: self._startwriting()
+        cellrow = [None]*len(self._header)
+        for colname in dict_column_and_value:       
+            cellrow[self._lowern2col[colname.lower()] -1] = dict_column_and_value[colname]
+        self.writer.writerow(cellrow)
+    def close(self): 
+        if not self.writer: self._startwriting() # Header only
+        if self.wb:
+            super().close()
+            os.replace(self._tmpfn, self.fp)
+    def discard(self):
+        """Drop the output (processing failed): close and remove the temporary file."""
+        if self.wb: self.wb.close()
+        self.wb = None
+        self._tmpfn.unlink(missing_ok=True)
     
 # --------------------------- RO Excel for Geodata ---------------------------
 
-class GeoData(roExcel):
-    def __init__(self,  *args, **kwargs):        
-        super(roExcel, self).__init__(*args, **kwargs)
+def _km(meters): return f"{meters/1000:.1f} km"
+
+class GeoData():
+    """Known data table, read into memory once. 
+
+    Header rows (column names, rules) are kept as lists, data rows as one tuple per column,
+    with strings interned. The workbook is closed after loading. Row numbers are Excel row numbers.
+
+    With use_cache, the loaded table and the compiled rules are pickled next to the 
+    data file (file name + .cache) and reused as long as the data file does not change.
+    Cache files are trusted like the data files themselves."""
+    cache_version = 2 # Change when the pickled structure changes
+
+    def __init__(self, filename, first_data_line_number):        
+        self.fp = Path(filename)
+        self.first_data_line = first_data_line_number
         # TODO: Hardcoded for now, move to config!
         self._row_colnames = 1
         self._row_rules = 2 # Excel indexing, 2nd row!
-        self.first_data_row = 4 # Default first data row
-        self._strdata = None # A tuple with data, preconverted to str for speed
+        self.first_data_row = first_data_line_number # Default first data row
         self._rulesrow = None
         self._colnamesrow = None
-        
+        self._plans = {} # Compiled rules, by rule names
+        self._cachekey = None # Set if caching is used
+        self._cache_dirty = False
+        self._load()
+
+    def _load(self):
+        wb = _openpyxl().load_workbook(self.fp, read_only=True)
+        try:
+            sheet = wb.active
+            sheet.reset_dimensions() # Do not trust the size stored in the file
+            rows = list(iter_sheet_values(sheet))
+        finally: wb.close()
+        width = max( (len(row) for row in rows), default=0 )
+        rows = [ row + (None,)*(width - len(row)) for row in rows ]
+        self._headerrows = rows[:self.first_data_row]
+        # NOTE: Data is read after the first self.first_data_row rows
+        datarows = rows[self.first_data_row:]
+        if datarows:
+            self._columns = tuple( tuple( sys.intern(v) if isinstance(v,str) else v for v in column ) for column in zip(*datarows) )
+        else: self._columns = ((),) * width
+
     @classmethod
-    def fromfile(GeoData, fn,  sheetname, first_data_row=4):        
+    def fromfile(GeoData, fn,  sheetname, first_data_row=4, use_cache=False, cache_settings=()):        
+        """Load known data from an Excel file. 
+
+        cache_settings = other settings (like normalization) the cache should depend on."""
     # TODO: NO OPTION TO PASS SHEET NAME
         fp = Path(fn)
         if not fp.exists(): raise jkError(f"File {fp} does not exist")
+        if use_cache:
+            cachekey = GeoData._cachekey_for(fp, first_data_row, cache_settings)
+            x = GeoData._fromcache(fp, cachekey)
+            if x: return x
         x = GeoData(fn,first_data_row)
         
-        x.first_data_row = first_data_row
         x._colnamesrow = [ s or "" for s in x.get_row(x._row_colnames) ] # Replaces None with ""
         x._colnamesrow = [ s.strip() for s in x._colnamesrow ]
         x._rulesrow = [ s or "" for s in x.get_row(x._row_rules) ] # Replaces None with ""
@@ -169,17 +397,87 @@ class GeoData(roExcel):
 #        print("collrules = ", x.reverse_column_names)
 #        print("rules = ", x.reverse_rules)
         assert len(x.reverse_column_names) == len(x.reverse_rules)
+        if use_cache:
+            x._cachekey = cachekey
+            x._cache_dirty = True
         return x
 
+    # CACHE FILES
+    @staticmethod
+    def cachefile_for(fp): return fp.with_name(fp.name + ".cache")
+
+    @staticmethod
+    def _cachekey_for(fp, first_data_row, settings):
+        stat = fp.stat()
+        return {"version": GeoData.cache_version, "size": stat.st_size, "mtime": stat.st_mtime_ns, 
+            "first_data_row": first_data_row, "settings": settings}
+
+    @staticmethod
+    def _fromcache(fp, cachekey):
+        """Return GeoData from the cache file of fp, or None if there is none or it is out of date."""
+        cfp = GeoData.cachefile_for(fp)
+        if not cfp.exists(): return None
+        try:
+            with cfp.open("rb") as f:
+                oldkey = pickle.load(f)
+                if any( oldkey.get(k) != cachekey[k] for k in ["version", "size", "first_data_row", "settings"] ): 
+                    log.info(f"Cache file {cfp} is out of date")
+                    return None
+                if oldkey["mtime"] != cachekey["mtime"] and oldkey["hash"] != jktools.filehash(fp): # Same content but touched is OK
+                    log.info(f"Cache file {cfp} is out of date")
+                    return None
+                x = pickle.load(f)
+        except Exception as err: # Any problem with the cache just means reading the data file
+            log.warning(f"Could not read cache file {cfp}: {err}")
+            return None
+        log.debug(f"Read known data from cache file {cfp}")
+        x.fp = fp
+        x._cachekey = cachekey
+        x._cache_dirty = oldkey["mtime"] != cachekey["mtime"] # Refresh with the new time
+        return x
+
+    def update_cache(self):
+        """Write the cache file, if caching is used and something new has been loaded or parsed."""
+        if not self._cachekey or not self._cache_dirty: return
+        cfp = self.cachefile_for(self.fp)
+        tmpfp = cfp.with_name(cfp.name + ".tmp")
+        try:
+            cachekey = dict(self._cachekey, hash=jktools.filehash(self.fp))
+            with tmpfp.open("wb") as f:
+                pickle.dump(cachekey, f)
+                pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpfp, cfp)
+            self._cache_dirty = False
+            log.debug(f"Wrote cache file {cfp}")
+        except OSError as err: # E.g. a read-only shared drive. Not fatal.
+            log.warning(f"Could not write cache file {cfp}: {err}")
+
+    @property
+    def filename(self): return self.fp
+    @property
+    def ncols(self): return len(self._columns)
+    @property
+    def nrows(self): return len(self._headerrows) + self.ndatarows
+    @property
+    def ndatarows(self): 
+        if self._columns: return len(self._columns[0])
+        else: return 0
     @property
     def rulesrow(self): return self._rulesrow
-    
     @property
     def colnamesrow(self): return self._colnamesrow
+
+    def close(self): pass # Workbook was closed after loading
+
+    def _dataindex(self, nrow): return nrow - self.first_data_row - 1
+
+    def get_row(self,n):# Direct row access, 1-based indexing
+        if n <= len(self._headerrows): return list(self._headerrows[n-1])
+        return [ column[self._dataindex(n)] for column in self._columns ]
         
     def parse_rules(self,rulenames):        
-        """Find columns with rules and store them. rulenames = a list of allowed rule names."""
-        self._update_name2column() # Make sure we have an index of column names
+        """Find columns with rules and compile them into a jktest.RulePlan. rulenames = a list of allowed rule names."""
+        if tuple(rulenames) in self._plans: return self._plans[tuple(rulenames)]
         rules = []
         lowercolnames = [x.strip().lower() for x in self.colnamesrow]
         ruleslower = [x.strip().lower() for x in self.rulesrow]
@@ -189,46 +487,37 @@ class GeoData(roExcel):
             if inrule not in rulenames: continue
             rule = jktest.singlerule( i, self.colnamesrow[i], inrule)
             rules.append(rule)                
-        return tuple(rules)
+        plan = jktest.RulePlan(rules, self._columns)
+        self._plans[tuple(rulenames)] = plan
+        self._cache_dirty = True
+        return plan
 
     def get_result_dict(self,nrow,acceptedtypes):
         cols = [x.lower() for x in self._colnamesrow]
-        row = self.get_row(nrow)
-        rules = self.rulesrow
-        cols = zip(cols ,row, rules)
-        retval = { k:(v or "") for (k,v,r) in cols if r and (r in acceptedtypes) }
+        n = self._dataindex(nrow)
+        cols = zip(cols ,self._columns, self.rulesrow)
+        retval = { k:(column[n] or "") for (k,column,r) in cols if r and (r in acceptedtypes) }
         return retval
 
     def get_data_rows(self):
-        if not self._strdata:
-            self._strdata = list(self.sheet.values)
-            for n in range(self.first_data_row): del self._strdata[0] # skip header lines
-            self._strdata = tuple(self._strdata)
-        return self._strdata
-
-    def find_matches(self, datadict,  rules, ignorechars="",normalize_dict={}): 
-        """Recturns a lregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsregular_subsist of indices to matching rows """
-        matches = []         
-        # Standardize value: no double spaces, no .;:
-        normalized_data_row = {k: jktools.loc_normalize(v,ignorechars,normalize_dict) for (k, v ) in datadict.items()}
-        # Test each known georef row and look for perfect matches for all tests.
-        nrow = 0
-        try:
-            for row in self.get_data_rows():
-                nrow += 1                
-                testsuccesses = 0 
-                matchall = True # Match all rules (rule1 AND rule2 AND ...)
-                for rule in rules:
-                    test_against_value = row[rule.col] # Get geodata value to test user data against
-                    testresultcode = rule.match(normalized_data_row, test_against_value)
-                    testsuccesses += testresultcode
-                    if ( testresultcode == 2 ): # Failure to match
-                        matchall = False
-                        break   
-                if matchall and (testsuccesses > 0) :  # If testsuccess == 0, all tests defaulted to success because there was no data to test
-                    matches.append(nrow + self.first_data_line) # Store row number of matching row (correct for skipperd header lines)
-        except ValueError: pass        
-        return matches
+        return tuple(zip(*self._columns))
+    def find_matches(self, datadict,  rules, normalizer=None): 
+        """Returns a list of indices to matching rows. 
+
+        rules = a jktest.RulePlan from parse_rules(), normalizer = a jktools.Normalizer"""
+        if normalizer is None: normalizer = jktools.Normalizer()
+        # Standardize values of the columns used by the rules: no double spaces, no .;:
+        normalized_data_row = normalizer.normalize_dict(datadict, rules.colnames)
+        return self.find_normalized_matches(normalized_data_row, rules)
+
+    def find_normalized_matches(self, normalized_data_row, rules): 
+        """As find_matches(), for a data row already normalized."""
+        # Store row numbers of matching rows (correct for skipped header lines)
+        return [ n + 1 + self.first_data_line for n in rules.match_rows(normalized_data_row) ]
+
+    def find_normalized_matches_batch(self, normalized_data_rows, batchplan): 
+        """As find_normalized_matches() for a list of rows, with a jkbatch.BatchPlan. Returns a list of lists."""
+        return [ [ n + 1 + self.first_data_line for n in found ] for found in batchplan.match_rows(normalized_data_rows) ]
         
     def get_output_action_for_column(self, column_name, acceptedtypes):
         """Find in which column it occurs in with an accepted output type.
@@ -255,4 +544,275 @@ class GeoData(roExcel):
         for n in range(len(self.rulesrow)):
             if self.rulesrow[n] in actions: names.append(self.colnamesrow[n])
         return names
-    
+
+class OutputPlan():
+    """What a matching GeoData row writes into an output file with the columns outcolnames.
+
+    The output columns and their operations are found once for each GeoData file and output 
+    file. The output of each matched row is kept as a tuple of (column name, operation, value), 
+    with the same columns and values as get_result_dict(), columns not in the output file 
+    and values marked to keep the original data left out. Operation is None for columns 
+    without an accepted output operation (values are still reported as original data)."""
+    def __init__(self, geodata, outcolnames, acceptedtypes, outputops, keepmarker):
+        self.geodata = geodata
+        self.keepmarker = keepmarker
+        columns = {} # As in get_result_dict(): the last of columns with the same name is used
+        for (k, column, r) in zip((x.lower() for x in geodata.colnamesrow), geodata._columns, geodata.rulesrow):
+            if r and (r in acceptedtypes): columns[k] = column
+        self._columns = tuple( (k, column, geodata.get_output_action_for_column(k, outputops)) 
+            for (k, column) in columns.items() if k in outcolnames )
+        self._rows = {} # Row number -> output items
+
+    def items(self, nrow):
+        """Return (column name, operation, value) tuples for GeoData row nrow."""
+        try: return self._rows[nrow]
+        except KeyError: pass
+        n = self.geodata._dataindex(nrow)
+        items = []
+        for (k, column, oper) in self._columns:
+            val = column[n] or ""
+            if jktools.my2str(val).strip().lower() == self.keepmarker: continue # Overrule marker in known_data
+            items.append( (k, oper, val) )
+        self._rows[nrow] = items = tuple(items)
+        return items
+
+# --------------------------- Several known data files ---------------------------
+
+class GeoDataSet():
+    """Several GeoData files searched in one pass. Matches are (GeoData, row number) pairs. 
+
+    Search modes:
+    - cascade: files are searched in the given order, the first file giving a unique match is used.
+    - merged: matches from all files together, a unique match is a match in one row of one file.
+
+    find_matches() caches its results by the normalized values of the rule columns (cachesize
+    most recently used), as the same localities repeat a lot in input files.
+
+    Time spent in normalising and matching, rule tests and cache use are collected in stats
+    (a jktools.Stats), see pop_stats()."""
+    searchmodes = ("cascade", "merged")
+
+    def __init__(self, geodatas, rulenames, search="cascade", cachesize=0):
+        if search not in self.searchmodes: 
+            raise jkError(f"Unknown known data search mode '{search}', should be one of {', '.join(self.searchmodes)}")
+        self.search = search
+        self.geodatas = tuple(geodatas)
+        self.plans = tuple( gd.parse_rules(rulenames) for gd in self.geodatas )
+        self.colnames = tuple({ k: None for plan in self.plans for k in plan.colnames }) # User data columns used by any rules
+        self.cache = jktools.LRUCache(cachesize)
+        self.stats = jktools.Stats()
+        self._outputplans = {}
+        self._batchplans = None
+        self._suggestions = None
+        self._diagnoses = jktools.LRUCache(cachesize)
+        self._spatial = None
+        self._points = {} # (GeoData, row number) -> (latitude, longitude, radius)
+
+    def __iter__(self): return iter(self.geodatas)
+    def __len__(self): return len(self.geodatas)
+
+    def output_column_names(self, actions=[]):
+        names = []
+        for gd in self.geodatas:
+            names.extend( n for n in gd.output_column_names(actions) if n not in names )
+        return names
+
+    def match_key(self, datadict, normalizer=None):
+        """The normalized values of the rule columns of datadict as a tuple. Rows with the same key have the same matches."""
+        if normalizer is None: normalizer = jktools.Normalizer()
+        normalized_data_row = normalizer.normalize_dict(datadict, self.colnames)
+        return tuple( normalized_data_row.get(k) for k in self.colnames )
+
+    def find_matches(self, datadict, normalizer=None): 
+        """Return a tuple of (GeoData, row number) pairs."""
+        if normalizer is None: normalizer = jktools.Normalizer()
+        start = time.perf_counter()
+        normalized_data_row = normalizer.normalize_dict(datadict, self.colnames) # Once for all files
+        normalized = time.perf_counter()
+        self.stats.times["normalise"] += normalized - start
+        if not self.cache.maxsize: found = tuple(self._find_normalized(normalized_data_row))
+        else:
+            key = tuple( normalized_data_row.get(k) for k in self.colnames )
+            found = self.cache.get(key)
+            if found is None:
+                found = tuple(self._find_normalized(normalized_data_row))
+                self.cache.put(key, found)
+        self.stats.times["match"] += time.perf_counter() - normalized
+        return found
+
+    def search_stops(self, datadict, normalizer=None):
+        """Return the rows where the search of find_matches() stops on a date that could not be parsed,
+        as (GeoData, row number) pairs. Files a cascade search would not reach are included too."""
+        if normalizer is None: normalizer = jktools.Normalizer()
+        normalized_data_row = normalizer.normalize_dict(datadict, self.colnames)
+        stops = ( (gd, plan.stop_row(normalized_data_row)) for (gd, plan) in zip(self.geodatas, self.plans) )
+        return tuple( (gd, n + 1 + gd.first_data_line) for (gd, n) in stops if n is not None )
+
+    def prepare_batch(self):
+        """Build the plans of the vectorised engine (find_matches_batch), needs NumPy and pandas."""
+        if self._batchplans is None:
+            try: jkbatch = jktools.timed_import("jkbatch")
+            except ImportError as err: raise jkError(f"The batch matching engine needs numpy and pandas ({err}).")
+            self._batchplans = tuple( jkbatch.BatchPlan(plan.rules, gd._columns) for (gd, plan) in zip(self.geodatas, self.plans) )
+        return self._batchplans
+
+    def find_matches_batch(self, datadicts, normalizer=None): 
+        """As find_matches() for a list of data rows at once, with the vectorised engine. Returns a list of tuples."""
+        if normalizer is None: normalizer = jktools.Normalizer()
+        with self.stats.timer("normalise"):
+            normalized = [ normalizer.normalize_dict(d, self.colnames) for d in datadicts ] # Once for all files
+        with self.stats.timer("match"):
+            return self._find_normalized_batch(normalized)
+
+    def _find_normalized_batch(self, normalized):
+        results = [ [] for d in normalized ]
+        todo = list(range(len(normalized))) # Rows still searched
+        for (gd, batchplan) in zip(self.geodatas, self.prepare_batch()):
+            found = gd.find_normalized_matches_batch([ normalized[i] for i in todo ], batchplan)
+            stillsearched = []
+            for (i, rows) in zip(todo, found):
+                if self.search == "cascade" and len(rows) == 1: 
+                    results[i] = [ (gd, rows[0]) ]
+                    continue
+                results[i].extend( (gd, n) for n in rows )
+                stillsearched.append(i)
+            todo = stillsearched
+        return [ tuple(r) for r in results ]
+
+    def prepare_suggestions(self):
+        """Build the near-miss indexes used by diagnose()."""
+        if self._suggestions is None:
+            self._suggestions = tuple( jksuggest.SuggestionIndex(plan.rules, gd._columns) for (gd, plan) in zip(self.geodatas, self.plans) )
+        return self._suggestions
+
+    def diagnose(self, datadict, matches, normalizer=None):
+        """Describe why a data row has no match or several matches (matches from find_matches()), as a string.
+
+        Values not found in the rule column of any known data file are listed with similar known 
+        values (see jksuggest). Results are cached as those of find_matches()."""
+        key = self.match_key(datadict, normalizer)
+        diagnosis = self._diagnoses.get(key)
+        if diagnosis is None:
+            diagnosis = self._diagnose(dict(zip(self.colnames, key)), matches)
+            self._diagnoses.put(key, diagnosis)
+        return diagnosis
+
+    def _diagnose(self, normalized_data_row, matches):
+        if matches:
+            rows = collections.defaultdict(list)
+            for (gd, n) in matches: rows[gd].append(n)
+            desc = "; ".join( f"{gd.filename.name} rows {', '.join(str(n) for n in ns)}" for (gd, ns) in rows.items() )
+            differing = []
+            for (gd, plan) in zip(self.geodatas, self.plans):
+                if gd in rows: differing.extend( n for n in jksuggest.differing_columns(gd, rows[gd], plan.rules) if n not in differing )
+            if differing: return f"{len(matches)} matches ({desc}), differing in {', '.join(differing)}."
+            return f"{len(matches)} matches ({desc}) with the same rule values, duplicate rows in known data?"
+        nfiles = collections.Counter() # Files with an 'equal' rule for a column
+        unknown = {} # Column name: [value, number of files where it was not found, suggestions]
+        for index in self.prepare_suggestions():
+            nfiles.update( {rule.colname for rule in index.rules} )
+            for (rule, value, suggestions) in index.unknown_values(normalized_data_row):
+                found = unknown.setdefault(rule.colname, [value, 0, []])
+                found[1] += 1
+                found[2].extend( s for s in suggestions if s not in found[2] )
+        problems = []
+        for (colname, (value, nunknown, suggestions)) in unknown.items():
+            if nunknown < nfiles[colname]: continue # Known in some file
+            desc = f"{colname} '{value}' not in known data"
+            if suggestions: desc += f", similar: {', '.join(suggestions[:jksuggest.max_suggestions])}"
+            problems.append(desc)
+        if not problems: return "No match. All values are in known data, but not on the same row (or dates do not match)."
+        return "No match. " + ". ".join(problems) + "."
+
+    def prepare_coordinates(self, columns):
+        """Build the spatial index of the known data coordinates used by check_coordinates().
+
+        columns = names of the latitude, longitude, coordinate system and coordinate radius columns,
+        the last two are not needed. Rows without coordinates or with coordinates not understood are left out."""
+        if self._spatial is None:
+            for gd in self.geodatas:
+                names = [ n.lower() for n in gd.colnamesrow ]
+                cols = [ gd._columns[names.index(cn.lower())] if cn.lower() in names else None for cn in columns ]
+                if cols[0] is None or cols[1] is None: continue # No coordinates in this file
+                empty = ("",) * gd.ndatarows
+                for (n, values) in enumerate(zip(*( col or empty for col in cols ))):
+                    try: point = jkspatial.parse_point(*( jktools.my2str(v) for v in values ))
+                    except ValueError: continue
+                    if point: self._points[(gd, n + 1 + gd.first_data_line)] = point
+            self._spatial = jkspatial.SpatialIndex( (*point, match) for (match, point) in self._points.items() )
+        return self._spatial
+
+    def describe_row(self, gd, n):
+        """Values of the 'equal' rule columns of a known data row (not '*' or empty), with the file name and row number."""
+        row = gd.get_row(n)
+        values = []
+        for rule in self.plans[self.geodatas.index(gd)].rules:
+            v = jktools.my2str(row[rule.col]).strip()
+            if rule.type == "equal" and v and v != "*" and v not in values: values.append(v)
+        return f"{', '.join(values)} ({gd.filename.name} row {n})"
+
+    def check_coordinates(self, point, matches, tolerance=0.0):
+        """Compare a point (latitude, longitude, uncertainty in meters, see jkspatial.parse_point) to 
+        the coordinates of its matches (from find_matches()). Returns (description, far) where far is True
+        if the point is farther than the radius of the locality, the uncertainty and tolerance (meters) 
+        from all matched localities. Unless the point is near a matched locality, the nearest known
+        locality and the localities whose radius contains the point are described."""
+        (lat, lon, uncertainty) = point
+        located = [ (jkspatial.distance(lat, lon, p[0], p[1]), p[2], m) for m in matches for p in [self._points.get(m)] if p ]
+        far = False
+        if located:
+            (d, radius, m) = min(located, key=lambda x: x[0] - x[1])
+            if d - radius - uncertainty <= tolerance: return (f"OK, {_km(d)} from the matched locality.", False)
+            far = True
+            problems = [f"FAR: {_km(d)} from the matched locality {self.describe_row(*m)}, radius {_km(radius)}"]
+        elif matches: problems = ["The matched locality has no coordinates"]
+        else: problems = ["No matched locality"]
+        for (d, m) in self._spatial.nearest(lat, lon):
+            problems.append(f"Nearest known locality {self.describe_row(*m)}, {_km(d)}")
+        containing = self._spatial.containing(lat, lon)
+        if containing:
+            problems.append(f"Within the radius of {len(containing)} known localities: " + 
+                "; ".join( self.describe_row(*m) for (d, m) in containing[:jksuggest.max_suggestions] ))
+        return (". ".join(problems) + ".", far)
+
+    def pop_stats(self):
+        """Return the statistics collected so far and reset them, to collect them from worker processes.
+        
+        Rule tests done by the plans and cache use are added to stats first."""
+        for plan in self.plans + (self._batchplans or ()):
+            self.stats.count("rule_evaluations", plan.evaluations)
+            plan.evaluations = 0
+        (hits, misses) = self.cache.pop_stats()
+        self.stats.count("cache_hits", hits)
+        self.stats.count("cache_misses", misses)
+        return self.stats.pop_stats()
+
+    def add_stats(self, stats): self.stats.add_stats(stats)
+
+    def start_rule_timing(self):
+        """Count and time the tests of each rule, for profiling. Slows matching down."""
+        for plan in self.plans + (self._batchplans or ()): plan.start_timing()
+
+    def stop_rule_timing(self):
+        """Return a list of (GeoData, rule, tests, seconds) since start_rule_timing(), for rules with tests."""
+        times = []
+        for plans in [self.plans, self._batchplans or ()]:
+            for (gd, plan) in zip(self.geodatas, plans):
+                times.extend( (gd, rule, tests, seconds) for (rule, tests, seconds) in plan.stop_timing() if tests )
+        return times
+
+    def output_items(self, geodata, nrow, outcolnames, acceptedtypes, outputops, keepmarker):
+        """Return the output of GeoData row nrow as (column name, operation, value) tuples, see OutputPlan."""
+        key = (geodata, outcolnames, tuple(acceptedtypes), tuple(outputops), keepmarker)
+        plan = self._outputplans.get(key)
+        if plan is None: 
+            plan = self._outputplans[key] = OutputPlan(geodata, outcolnames, acceptedtypes, outputops, keepmarker)
+        return plan.items(nrow)
+
+    def _find_normalized(self, normalized_data_row):
+        matches = []
+        for (gd, plan) in zip(self.geodatas, self.plans):
+            found = [ (gd, n) for n in gd.find_normalized_matches(normalized_data_row, plan) ]
+            if self.search == "cascade" and len(found) == 1: return found
+            matches.extend(found)
+        return matches
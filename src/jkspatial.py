@@ -0,0 +1,139 @@
+# Coordinates of the known data in a spatial index, for checking the coordinates already in input rows.
+# Coordinates are WGS84 decimal degrees or Finnish uniform grid (YKJ) coordinates, which are
+# converted to WGS84. Localities have a radius (MYCoordinateRadius) and are treated as circles.
+import math, heapq, itertools
+
+earth_radius = 6371000.0 # Meters, mean radius
+
+# YKJ: Gauss-Krüger projection of the KKJ datum (Hayford ellipsoid), central meridian 27°E
+_ykj_a = 6378388.0
+_ykj_f = 1 / 297.0
+_ykj_lon0 = math.radians(27.0)
+_ykj_false_easting = 3500000.0
+
+def ykj_to_wgs84(northing, easting):
+    """Latitude and longitude in degrees of a point in YKJ coordinates (meters).
+
+    Inverse transverse Mercator with the Krüger series. The difference of the KKJ and WGS84 datums
+    (up to some hundred meters) is not corrected, which is enough for checking localities."""
+    n = _ykj_f / (2 - _ykj_f)
+    A = _ykj_a / (1 + n) * (1 + n**2/4 + n**4/64)
+    xi = northing / A
+    eta = (easting - _ykj_false_easting) / A
+    betas = (n/2 - 2*n**2/3 + 37*n**3/96, n**2/48 + n**3/15, 17*n**3/480)
+    deltas = (2*n - 2*n**2/3 - 2*n**3, 7*n**2/3 - 8*n**3/5, 56*n**3/15)
+    xi1 = xi - sum( b * math.sin(2*j*xi) * math.cosh(2*j*eta) for (j, b) in enumerate(betas, 1) )
+    eta1 = eta - sum( b * math.cos(2*j*xi) * math.sinh(2*j*eta) for (j, b) in enumerate(betas, 1) )
+    chi = math.asin(math.sin(xi1) / math.cosh(eta1))
+    lat = chi + sum( d * math.sin(2*j*chi) for (j, d) in enumerate(deltas, 1) )
+    lon = _ykj_lon0 + math.atan2(math.sinh(eta1), math.cos(xi1))
+    return (math.degrees(lat), math.degrees(lon))
+
+def parse_point(lat, lon, system="", radius=""):
+    """(latitude, longitude, uncertainty in meters) from the strings of the coordinate columns,
+    None if lat or lon is empty. Raises ValueError if the coordinates are not understood.
+
+    system = "wgs84" (or empty) for decimal degrees, or "ykj". YKJ coordinates can be shortened:
+    768:328 is the 10 km square with the corner 7680000:3280000, its center point is returned and
+    half of its diagonal is added to the uncertainty. radius = the coordinate radius in meters, if known."""
+    (lat, lon, system) = (lat.strip(), lon.strip(), system.strip().lower())
+    if not lat or not lon: return None
+    try: uncertainty = max(0.0, float(radius))
+    except ValueError: uncertainty = 0.0 # Radius is extra information only
+    if system in ("", "wgs84"):
+        (latitude, longitude) = (float(lat.replace(",", ".")), float(lon.replace(",", ".")))
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180): raise ValueError(f"coordinates out of range: {lat}, {lon}")
+        return (latitude, longitude, uncertainty)
+    if system == "ykj":
+        if not (lat.isdigit() and lon.isdigit() and len(lat) == len(lon) and 3 <= len(lat) <= 7):
+            raise ValueError(f"not YKJ coordinates: {lat}:{lon}")
+        size = 10 ** (7 - len(lat)) # Side of the square in meters
+        (latitude, longitude) = ykj_to_wgs84(int(lat)*size + size/2, int(lon)*size + size/2)
+        return (latitude, longitude, uncertainty + size * math.sqrt(0.5))
+    raise ValueError(f"unsupported coordinate system {system}")
+
+def distance(lat1, lon1, lat2, lon2):
+    """Great circle distance in meters of two points given in degrees (haversine formula)."""
+    (p1, p2) = (math.radians(lat1), math.radians(lat2))
+    h = math.sin((p2 - p1)/2)**2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1)/2)**2
+    return 2 * earth_radius * math.asin(min(1.0, math.sqrt(h)))
+
+def _unitvector(lat, lon):
+    (p, l) = (math.radians(lat), math.radians(lon))
+    return (math.cos(p) * math.cos(l), math.cos(p) * math.sin(l), math.sin(p))
+
+def _chord(meters): return 2 * math.sin(min(meters / (2 * earth_radius), math.pi/2)) # Straight line distance on the unit sphere
+def _arc(chord): return 2 * earth_radius * math.asin(min(1.0, chord / 2))
+
+def _dist2(u, v): return (u[0]-v[0])**2 + (u[1]-v[1])**2 + (u[2]-v[2])**2
+
+def _boxdist2(u, lo, hi):
+    """Squared distance of point u to the box (lo, hi), zero inside."""
+    d2 = 0.0
+    for i in range(3):
+        if u[i] < lo[i]: d2 += (lo[i] - u[i])**2
+        elif u[i] > hi[i]: d2 += (u[i] - hi[i])**2
+    return d2
+
+class _Node():
+    __slots__ = ("vector", "radius", "item", "lo", "hi", "maxradius", "left", "right")
+
+class SpatialIndex():
+    """k-d tree of localities (points with a radius), for finding the localities nearest to a point
+    and those whose circle contains the point.
+
+    Points are kept as 3-d unit vectors: straight line distances grow with the distances along
+    the surface of the earth, and nothing special is needed near the poles or the 180th meridian.
+    Each subtree has the bounding box of its points and the largest radius in it, so that the
+    subtrees that cannot have the nearest point or a circle with the point are skipped."""
+
+    def __init__(self, points):
+        """points = iterable of (latitude, longitude, radius in meters, item)."""
+        nodes = [ (_unitvector(lat, lon), _chord(radius), item) for (lat, lon, radius, item) in points ]
+        self.size = len(nodes)
+        self._root = self._build(nodes)
+
+    def __len__(self): return self.size
+
+    def _build(self, points):
+        if not points: return None
+        node = _Node()
+        node.lo = tuple( min(p[0][i] for p in points) for i in range(3) )
+        node.hi = tuple( max(p[0][i] for p in points) for i in range(3) )
+        node.maxradius = max( p[1] for p in points )
+        axis = max(range(3), key=lambda i: node.hi[i] - node.lo[i]) # Split the longest side at the median
+        points.sort(key=lambda p: p[0][axis])
+        m = len(points) // 2
+        (node.vector, node.radius, node.item) = points[m]
+        node.left = self._build(points[:m])
+        node.right = self._build(points[m+1:])
+        return node
+
+    def nearest(self, lat, lon, n=1):
+        """Return the n items nearest to the point as (distance in meters, item) pairs, nearest first."""
+        u = _unitvector(lat, lon)
+        found = [] # Heap of (-squared distance, counter, item), the farthest first
+        counter = itertools.count() # Ties are not decided by comparing items
+        todo = [ (0.0, next(counter), self._root) ] if self._root else []
+        while todo:
+            (boxd2, c, node) = heapq.heappop(todo)
+            if len(found) == n and boxd2 > -found[0][0]: break # Nearer points cannot be found
+            d2 = _dist2(u, node.vector)
+            if len(found) < n: heapq.heappush(found, (-d2, next(counter), node.item))
+            elif d2 < -found[0][0]: heapq.heapreplace(found, (-d2, next(counter), node.item))
+            for child in (node.left, node.right):
+                if child: heapq.heappush(todo, (_boxdist2(u, child.lo, child.hi), next(counter), child))
+        return [ (_arc(math.sqrt(-d2)), item) for (d2, c, item) in sorted(found, key=lambda x: (-x[0], x[1])) ]
+
+    def containing(self, lat, lon):
+        """Return the items whose circle contains the point as (distance in meters, item) pairs, nearest first."""
+        u = _unitvector(lat, lon)
+        found = []
+        todo = [self._root] if self._root else []
+        while todo:
+            node = todo.pop()
+            if _boxdist2(u, node.lo, node.hi) > node.maxradius**2: continue
+            d2 = _dist2(u, node.vector)
+            if d2 <= node.radius**2: found.append( (_arc(math.sqrt(d2)), node.item) )
+            todo.extend( child for child in (node.left, node.right) if child )
+        return sorted(found, key=lambda x: x[0])
@@ -0,0 +1,149 @@
+# Incremental re-runs: the match results of an input file are kept in a state file next to
+# the output file, and reused when the same file is processed again.
+import pickle, hashlib, logging, os
+import jktools
+from pathlib import Path
+
+progname = 'paikkain'
+log = logging.getLogger(progname)
+
+state_version = 2 # Change when the pickled structure changes
+
+def statefile_for(outfn): return Path(outfn).with_name(Path(outfn).name + ".state")
+
+def _digest(x): return hashlib.blake2b(repr(x).encode(), digest_size=8).digest()
+
+def row_digests(geodata):
+    """Short digests of the data rows of geodata, for finding the rows changed between runs."""
+    return [ _digest(row) for row in geodata.get_data_rows() ]
+
+class IncrementalState():
+    """Match results of an input file from the previous run, for reusing them.
+
+    Results are stored by the normalized values of the rule columns (GeoDataSet.match_key()),
+    matches as (known data file number, row number) pairs, with the rows where the search stopped
+    on a date that could not be parsed. Row fingerprints of the input file and digests of the
+    known data files and their rows are stored with them.
+
+    All results are dropped if the match settings or the header rows (column names, rules) of
+    the known data files have changed. If some known data rows have changed, results are dropped
+    for those keys that matched a changed row, stopped on a changed row or that a changed row
+    could match now."""
+
+    def __init__(self, statefn, geodataset, matchsettings):
+        self.fp = Path(statefn)
+        self.geodataset = geodataset
+        self.settings = matchsettings
+        self.headers = [ (gd.filename.name, gd.colnamesrow, gd.rulesrow) for gd in geodataset ]
+        self.filehashes = [ jktools.filehash(gd.filename) for gd in geodataset ]
+        self._rowdigests = [ None ] * len(geodataset) # Computed when needed
+        self.results = {} # key -> matches as (file number, row number)
+        self.stops = {} # key -> rows where the search stopped as (file number, row number), if any
+        self._found = {} # key -> matches as (GeoData, row number), as from find_matches()
+        self.fingerprints = bytearray() # Of the input rows matched in this run
+        self.oldfingerprints = b""
+        self.input_hash = None # Input file and output settings of the previous run
+        self.output_settings = None
+        self.known_data_changed = False
+        self.loaded = False # Results of the previous run were read
+        self.reused = 0 # Rows matched with the results of the previous run
+        self._matched = set() # Keys matched in this run
+        self._load()
+
+    def _load(self):
+        if not self.fp.exists(): return
+        try:
+            with self.fp.open("rb") as f: old = pickle.load(f)
+        except Exception as err: # Any problem with the state file just means matching all rows again
+            log.warning(f"Could not read state file {self.fp}: {err}")
+            return
+        if old.get("version") != state_version or old["settings"] != self.settings or old["headers"] != self.headers:
+            log.info("Match settings or known data files have changed since the last run, all rows are matched again")
+            self.known_data_changed = True
+            return
+        changed = [] # Changed row numbers of each known data file
+        for (i, gd) in enumerate(self.geodataset):
+            if old["filehashes"][i] == self.filehashes[i]:
+                self._rowdigests[i] = old["rowdigests"][i]
+                changed.append(frozenset())
+                continue
+            (olddigests, newdigests) = (old["rowdigests"][i], self.rowdigests(i))
+            rows = frozenset( n + 1 + gd.first_data_line for n in range(max(len(olddigests), len(newdigests)))
+                if n >= len(olddigests) or n >= len(newdigests) or olddigests[n] != newdigests[n] )
+            log.info(f"{len(rows)} rows of {gd.filename.name} have changed since the last run")
+            changed.append(rows)
+        (self.results, self.stops) = (old["results"], old["stops"])
+        if any(changed):
+            self.known_data_changed = True
+            self.results = { key: found for (key, found) in self.results.items() if not self._affected(key, found, changed) }
+            log.info(f"{len(old['results']) - len(self.results)} of {len(old['results'])} earlier results are affected by the changes")
+        self.oldfingerprints = old["fingerprints"]
+        self.input_hash = old["input_hash"]
+        self.output_settings = old["output_settings"]
+        self.loaded = True
+
+    def _affected(self, key, found, changed):
+        if any( n in changed[i] for (i, n) in found + self.stops.get(key, ()) ): return True
+        # Rows that can match (pass the indexed rules) are candidates of the index
+        userdata = { k: v for (k, v) in zip(self.geodataset.colnames, key) if v is not None }
+        for (i, (gd, plan)) in enumerate(zip(self.geodataset, self.geodataset.plans)):
+            if changed[i] and any( n + 1 + gd.first_data_line in changed[i] for n in plan.index.candidates(userdata) ):
+                return True
+        return False
+
+    def rowdigests(self, i):
+        if self._rowdigests[i] is None: self._rowdigests[i] = row_digests(self.geodataset.geodatas[i])
+        return self._rowdigests[i]
+
+    def up_to_date(self, input_hash, output_settings):
+        """True if the input file, the known data and the settings are the same as in the previous run."""
+        return (self.input_hash == input_hash and self.output_settings == output_settings and
+            not self.known_data_changed)
+
+    def find_matches(self, datadicts, normalizer, batch=False):
+        """As GeoDataSet.find_matches() for a list of data rows, reusing earlier results.
+
+        Rows with new keys are matched with find_matches_batch() if batch is set."""
+        keys = [ self.geodataset.match_key(d, normalizer) for d in datadicts ]
+        for key in keys: self.fingerprints += _digest(key)
+        new = {}
+        for (key, d) in zip(keys, datadicts):
+            if key not in self.results: new.setdefault(key, d)
+        if new:
+            if batch: found = self.geodataset.find_matches_batch(list(new.values()), normalizer)
+            else: found = [ self.geodataset.find_matches(d, normalizer) for d in new.values() ]
+            numbers = { gd: i for (i, gd) in enumerate(self.geodataset) }
+            for (key, matches) in zip(new, found):
+                self.results[key] = tuple( (numbers[gd], n) for (gd, n) in matches )
+                self._found[key] = matches
+                stops = tuple( (numbers[gd], n) for (gd, n) in self.geodataset.search_stops(new[key], normalizer) )
+                if stops: self.stops[key] = stops
+                else: self.stops.pop(key, None)
+        self.reused += sum( 1 for key in keys if key not in new and key not in self._matched )
+        self._matched.update(new)
+        return [ self._matches(key) for key in keys ]
+
+    def _matches(self, key):
+        found = self._found.get(key)
+        if found is None:
+            geodatas = self.geodataset.geodatas
+            found = self._found[key] = tuple( (geodatas[i], n) for (i, n) in self.results[key] )
+        return found
+
+    def changed_rows(self):
+        """Number of input rows matched in this run with other rule column values than in the previous run (by row number)."""
+        (old, new) = (self.oldfingerprints, self.fingerprints)
+        common = min(len(old), len(new)) // 8
+        changed = sum( 1 for i in range(0, common*8, 8) if old[i:i+8] != new[i:i+8] )
+        return changed + abs(len(old) - len(new)) // 8
+
+    def save(self, input_hash, output_settings):
+        """Write the state file, with the results of the keys seen in this run only."""
+        state = { "version": state_version, "settings": self.settings, "headers": self.headers,
+            "filehashes": self.filehashes, "rowdigests": [ self.rowdigests(i) for i in range(len(self.geodataset)) ],
+            "results": { k: self.results[k] for k in self._found },
+            "stops": { k: self.stops[k] for k in self._found if k in self.stops }, "fingerprints": bytes(self.fingerprints),
+            "input_hash": input_hash, "output_settings": output_settings }
+        tmpfp = self.fp.with_name(self.fp.name + ".tmp")
+        with tmpfp.open("wb") as f: pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfp, self.fp)
@@ -0,0 +1,140 @@
+# Near-miss suggestions for input rows with no match or several matches.
+# Values of the 'equal' rule columns of the known data are indexed in a trie (for values
+# the user has written shortened) and a BK-tree (for misspelled values), so that similar
+# known values are found without comparing the input value to every known data row.
+import logging
+from jktools import my2str
+
+progname = 'paikkain'
+log = logging.getLogger(progname)
+
+max_suggestions = 3 # Suggested values for each column
+
+def edit_distance(a, b):
+    """Levenshtein distance of strings a and b.
+
+    Bit-parallel (Myers 1999, Hyyrö 2001): the column of the distance matrix is kept in the bits 
+    of two integers, so the work is one step per character of b instead of len(a) steps."""
+    if not a: return len(b)
+    if not b: return len(a)
+    positions = {} # Bit mask of the positions of each character in a
+    for (i, c) in enumerate(a): positions[c] = positions.get(c, 0) | (1 << i)
+    mask = (1 << len(a)) - 1
+    last = 1 << (len(a) - 1)
+    (pv, mv, score) = (mask, 0, len(a)) # Vertical +1 and -1 differences
+    for c in b:
+        eq = positions.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv) # Horizontal +1 and -1 differences
+        mh = pv & xh
+        if ph & last: score += 1
+        elif mh & last: score -= 1
+        ph = (ph << 1) | 1
+        mh <<= 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv & mask
+    return score
+
+def max_distance(value):
+    """Edit distance accepted for a suggestion: more for long values."""
+    return max(1, min(2, len(value) // 4))
+
+class Trie():
+    """Prefix tree of strings, for finding the values starting with a prefix."""
+    _end = None # Key of the value stored at a node
+
+    def __init__(self, values=()):
+        self._root = {}
+        for v in values: self.add(v)
+
+    def add(self, value):
+        node = self._root
+        for c in value: node = node.setdefault(c, {})
+        node[self._end] = value
+
+    def startingwith(self, prefix, limit=max_suggestions):
+        """Return up to limit values starting with prefix, shortest first."""
+        node = self._root
+        for c in prefix:
+            node = node.get(c)
+            if node is None: return []
+        found = []
+        level = [node]
+        while level and len(found) < limit: # Breadth first: shortest values first
+            nextlevel = []
+            values = []
+            for node in level:
+                for (c, child) in node.items():
+                    if c is self._end: values.append(child)
+                    else: nextlevel.append(child)
+            found.extend(sorted(values))
+            level = nextlevel
+        return found[:limit]
+
+class BKTree():
+    """Burkhard-Keller tree of strings with the edit distance, for finding the values near a given value."""
+
+    def __init__(self, values=()):
+        self._root = None
+        for v in values: self.add(v)
+
+    def add(self, value):
+        if self._root is None:
+            self._root = (value, {})
+            return
+        node = self._root
+        while True:
+            d = edit_distance(value, node[0])
+            if d == 0: return # Already there
+            child = node[1].get(d)
+            if child is None:
+                node[1][d] = (value, {})
+                return
+            node = child
+
+    def near(self, value, maxdist):
+        """Return (distance, value) pairs of values within maxdist of value, nearest first."""
+        found = []
+        todo = [self._root] if self._root else []
+        while todo:
+            (nodevalue, children) = todo.pop()
+            d = edit_distance(value, nodevalue)
+            if d <= maxdist: found.append( (d, nodevalue) )
+            todo.extend( child for (cd, child) in children.items() if d - maxdist <= cd <= d + maxdist )
+        return sorted(found)
+
+class SuggestionIndex():
+    """Near-miss lookup for the 'equal' rule columns of one known data file (see jktest.RulePlan).
+
+    Values are compared as the rules compare them (stripped, lowercase)."""
+
+    def __init__(self, rules, columns):
+        self.rules = [ rule for rule in rules if rule.type == "equal" ]
+        self._values = [] # Set of known values of each rule
+        self._tries = []
+        self._bktrees = []
+        for rule in self.rules:
+            values = { v for v in (rule.prepare(x) for x in columns[rule.col]) if v } # Not '*' or empty
+            self._values.append(values)
+            self._tries.append(Trie(sorted(values)))
+            self._bktrees.append(BKTree(sorted(values)))
+
+    def unknown_values(self, userdata):
+        """Yield (rule, user value, suggestions) for the non-empty user values not found in their
+        column of the known data. userdata = dict of normalized values."""
+        for (rule, values, trie, bktree) in zip(self.rules, self._values, self._tries, self._bktrees):
+            uservalue = rule.prepare_user(userdata)
+            if not uservalue or uservalue in values: continue
+            suggestions = [ v for (d, v) in bktree.near(uservalue, max_distance(uservalue)) ]
+            if len(uservalue) >= 3:
+                suggestions.extend( v for v in trie.startingwith(uservalue) if v not in suggestions )
+            yield (rule, uservalue, suggestions[:max_suggestions])
+
+def differing_columns(geodata, rows, rules):
+    """Names of the rule columns where the given rows of geodata have different values."""
+    names = []
+    for rule in rules:
+        values = { my2str(geodata.get_row(n)[rule.col]).strip().lower() for n in rows }
+        if len(values) > 1 and rule.colname not in names: names.append(rule.colname)
+    return names
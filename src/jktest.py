@@ -1,7 +1,8 @@
 from jkerror import jkError
-from jktools import loadtime,  streq
+from jktools import loadtime,  parse_date,  streq,  my2str
 import operator
 import logging
+import time
 progname = 'paikkain'
 log = logging.getLogger(progname)
 
@@ -10,6 +11,7 @@ _verbose = True
 datebefore = 'datebefore'
 dateafter ='dateafter'
 known_test_types = ("equal", "datebefore", "dateafter","notempty")
+untestable = 3 # Compiled tests only: a date could not be recognised, stops the search
 
 def isempty(x): 
     if x is None: return True
@@ -28,6 +30,7 @@ class singlerule():
         self.lowercolname=colname.lower()
         self.type = rule_type.strip().lower()
         if self.type not in known_test_types: raise jkError(f"Unknown test type {self.type}")        
+        self._cmpfnc = {datebefore: operator.le, dateafter: operator.ge}.get(self.type) # userdate before/after (or equal to) geodata test date
 
     def _equaltest(self, userval,  geoval): 
         if ( isempty(geoval) and isempty(userval) ) : return  1 # success
@@ -85,5 +88,179 @@ class singlerule():
                 if self.type == dateafter: cmpfnc = operator.ge # after or equal
                 retval = self._timetest(userval,  geoval,  cmpfnc)
             return retval
-        else: raise jkError(f"Unknown test type {self.type } for test {self.colname}")        
-    
+        else: raise jkError(f"Unknown test type {self.type } for test {self.colname}")
+
+
+    # COMPILED TESTS, used by RulePlan. Geodata values are prepared once when the plan is built, 
+    # user values once per input row. Results are the same as from match().
+    def prepare(self, geodata):
+        """Convert a geodata cell to the form compare() expects. None means no test requested ('*')."""
+        geoval = my2str(geodata).strip()
+        if (geoval == "*"): return None
+        if self.type == "equal": return geoval.lower()
+        elif self.type in [datebefore,  dateafter]:
+            return (geoval, parse_date(geoval)) # None if not recognised
+        else: return geoval
+
+    def prepare_user(self, userdata):
+        userval = str(userdata.get(self.lowercolname, '') or "").strip()
+        if self.type == "equal": return userval.lower()
+        elif self.type in [datebefore,  dateafter]: return (userval, parse_date(userval))
+        else: return userval
+
+    @property
+    def compare(self):
+        """Test function for this rule type, called with prepared user and geodata values."""
+        if self.type == "equal": return self._cmp_equal
+        elif self.type == "notempty": return self._cmp_notempty
+        else: return self._cmp_date
+
+    def _cmp_equal(self, userval, geoval):
+        if geoval is None: return 0
+        elif geoval == userval: return 1 # Also empty matches empty
+        else: return 2
+
+    def _cmp_notempty(self, userval, geoval):
+        if geoval is None: return 0
+        elif isempty(userval): return 2
+        else: return 1
+
+    def _cmp_date(self, user, geo):
+        if geo is None: return 0
+        (geoval, geodate) = geo
+        (userval, userdate) = user
+        if ( isempty(geoval) and isempty(userval) ) : return 1 # empty matches empty
+        elif isempty(geoval) or isempty(userval): return 2 # empty and non-empty: fail
+        elif userdate is None or geodate is None:
+            log.info(f"Failed to convert '{userval}' or '{geoval}' to a Date: Date format not recognised" )
+            return untestable
+        elif self._cmpfnc(userdate, geodate): return 1
+        else: return 2
+
+
+def index_rules(rules):
+    """The rules that can be used as an index: 'equal' rules preceding the first date rule."""
+    keyrules = []
+    for rule in rules:
+        if rule.type in [datebefore,  dateafter]: break
+        if rule.type == "equal": keyrules.append(rule)
+    return keyrules
+
+class MatchIndex():
+    """Hash index over the 'equal' rule columns of the known data (a sequence of columns).
+
+    Rows are grouped by which indexed columns hold a real value (the rest are '*' wildcards),
+    and within a group keyed by the lowercased values, so candidates() only returns rows 
+    that can pass all indexed tests. Only 'equal' rules preceding the first date rule are
+    indexed: a row rejected by them never reaches a date test, which keeps the behaviour on 
+    unparseable dates identical to a full scan."""
+
+    def __init__(self, columns, rules):
+        self.keyrules = index_rules(rules)
+        keycolumns = [ [ rule.prepare(v) for v in columns[rule.col] ] for rule in self.keyrules ]
+        self._groups = {} # wildcard mask -> { tuple of lowercased values: [row indices] }
+        for nrow in range(len(columns[0]) if columns else 0):
+            mask = []
+            key = []
+            for (i, column) in enumerate(keycolumns):
+                geoval = column[nrow]
+                if geoval is None: continue  # '*' matches anything, not part of the key
+                mask.append(i)
+                key.append(geoval)
+            self._groups.setdefault(tuple(mask), {}).setdefault(tuple(key), []).append(nrow)
+
+    def candidates(self, userdata):
+        """Return a sorted list of (zero-based) indices of rows that pass all indexed tests."""
+        uservals = [ rule.prepare_user(userdata) for rule in self.keyrules ]
+        found = []
+        for mask, table in self._groups.items():
+            found.extend( table.get(tuple(uservals[i] for i in mask), ()) )
+        found.sort()
+        return found
+
+
+class RulePlan():
+    """Rules compiled against the data columns of a known data file.
+
+    The geodata cells used by each rule are prepared (stripped, lowercased, dates parsed) once,
+    and each rule is bound to the comparison function of its type, so matching an input row
+    only does work on the user values. Iterating over a plan gives the singlerule objects."""
+    ruletimes = None # [tests, seconds] for each rule between start_timing() and stop_timing()
+    _baddates = None # Rows with a date that could not be parsed, see stop_row()
+
+    def __init__(self, rules, columns):
+        self.rules = tuple(rules)
+        self.colnames = tuple({ rule.lowercolname: None for rule in self.rules }) # User data columns used by the rules
+        self.index = MatchIndex(columns, self.rules)
+        self._tests = tuple( (rule, rule.compare, tuple(rule.prepare(v) for v in columns[rule.col])) for rule in self.rules )
+        self.evaluations = 0 # Rule tests done by match_rows(), for statistics
+
+    def __iter__(self): return iter(self.rules)
+    def __len__(self): return len(self.rules)
+
+    def start_timing(self):
+        """Count and time the tests of each rule (for profiling), until stop_timing() is called."""
+        if self.ruletimes is not None: return
+        self.ruletimes = [ [0, 0.0] for rule in self.rules ]
+        self._untimed = self._tests
+        self._tests = tuple( (rule, _timed(compare, counter), column) for ((rule, compare, column), counter) in zip(self._tests, self.ruletimes) )
+
+    def stop_timing(self):
+        """Return a list of (rule, tests, seconds) since start_timing()."""
+        if self.ruletimes is None: return []
+        self._tests = self._untimed
+        del self._untimed
+        (times, self.ruletimes) = (self.ruletimes, None)
+        return [ (rule, tests, seconds) for (rule, (tests, seconds)) in zip(self.rules, times) ]
+
+    def match_rows(self, userdata):
+        """Return a list of zero-based indices of the rows matching all rules. 
+
+        A row matches if no test fails and at least one test was really done. 
+        If a date can not be parsed, the search stops and the rows found so far are returned."""
+        tests = [ (rule.prepare_user(userdata), compare, column) for (rule, compare, column) in self._tests ]
+        matches = []
+        evaluations = 0
+        for n in self.index.candidates(userdata):
+            testsuccesses = 0
+            for (userval, compare, column) in tests: # Match all rules (rule1 AND rule2 AND ...)
+                evaluations += 1
+                testresultcode = compare(userval, column[n])
+                if ( testresultcode >= 2 ): break # Failure to match
+                testsuccesses += testresultcode
+            else:
+                if testsuccesses > 0: matches.append(n) # If testsuccess == 0, all tests defaulted to success because there was no data to test
+                continue
+            if testresultcode == untestable: break
+        self.evaluations += evaluations
+        return matches
+
+    def stop_row(self, userdata):
+        """Return the (zero-based) index of the row where match_rows() stops the search on a date
+        that could not be parsed, None if the search does not stop. Nothing is logged."""
+        tests = [ (rule.type in [datebefore,  dateafter], rule.prepare_user(userdata), compare, column)
+            for (rule, compare, column) in getattr(self, "_untimed", self._tests) ]
+        rows = self.index.candidates(userdata)
+        if not any( isdate and userval[0] and userval[1] is None for (isdate, userval, compare, column) in tests ):
+            if self._baddates is None: # Only rows with unparsed dates can stop the search
+                self._baddates = frozenset( n for (isdate, userval, compare, column) in tests if isdate
+                    for (n, geo) in enumerate(column) if geo is not None and geo[0] and geo[1] is None )
+            rows = [ n for n in rows if n in self._baddates ]
+        for n in rows:
+            for (isdate, userval, compare, column) in tests:
+                geo = column[n]
+                if isdate and geo is not None and not isempty(geo[0]) and not isempty(userval[0]) and None in (userval[1], geo[1]):
+                    return n
+                if compare(userval, geo) >= 2: break
+        return None
+
+def _timed(compare, counter):
+    """compare() that adds 1 test and the time spent to counter = [tests, seconds]."""
+    clock = time.perf_counter
+    def timedcompare(userval, geoval):
+        start = clock()
+        try: return compare(userval, geoval)
+        finally: 
+            counter[0] += 1
+            counter[1] += clock() - start
+    return timedcompare
@@ -1,24 +1,38 @@
-import datetime,  re
+import datetime,  re,  functools,  collections,  time,  contextlib,  queue,  threading,  importlib,  sys,  hashlib
 
 dateformat1 = "%d.%m.%Y"
 dateformat2 = "%Y"
 today = datetime.date.today()
 
+# dateformat1 and dateformat2 as read by strptime, which is much slower
+_dateformat1_re = re.compile(r"(3[01]|[12]\d|0[1-9]|[1-9]| [1-9])\.(1[0-2]|0[1-9]|[1-9])\.(\d\d\d\d)")
+_dateformat2_re = re.compile(r"\d\d\d\d")
+
 def loadtime(tstring, ignore_characters = ["?"]):
     for c in ignore_characters:
         tstring = tstring.replace(c,"")
     t = str(tstring)
-    try: return datetime.datetime.strptime( t, dateformat1 )
-    except ValueError: pass
+    found = _dateformat1_re.fullmatch(t)
+    if found:
+        d,m,y = [int(x) for x in found.groups()]
+        try: return datetime.datetime(y,m,d)
+        except ValueError: pass # E.g. 31.2.
     # If format1 failed, try format 2 (year only)
-    try: return datetime.datetime.strptime( t, dateformat2 )
-    except ValueError: pass
+    if _dateformat2_re.fullmatch(t):
+        try: return datetime.datetime(int(t),1,1)
+        except ValueError: pass
     # Try m.YYYY
     try:
         m,y = [int(x) for x in t.split(".")]
         return datetime.datetime(y,m,1) # If only month-year given, uses 1st day of the month for testing
     except ValueError: raise ValueError(f"Date format not recognised for '{t}'")
 
+@functools.lru_cache(maxsize=4096)
+def parse_date(tstring):
+    """Cached loadtime(). Returns None if the date is not recognised."""
+    try: return loadtime(tstring)
+    except (ValueError, OverflowError): return None
+
 def my2str(x): 
     if x is None: return ""
     else: return str(x)
@@ -37,6 +51,156 @@ def  loc_normalize(s,ignorechars="",regular_subs = {}):
     for ch in ignorechars: s = s.replace(ch,"")
     return s
 
+class Normalizer():
+    """loc_normalize() with its settings prepared once.
+
+    The replacement patterns are compiled when created, ignored characters are removed with a 
+    translation table and results are cached, as the same locality strings repeat a lot in input files.
+    The replacements are applied one after another (later patterns see the output of earlier ones),
+    so they are not merged into one pattern."""
+    _whitespace = re.compile(r"\s+")
+
+    def __init__(self, ignorechars="", regular_subs={}, cachesize=8192):
+        self._settings = (ignorechars, dict(regular_subs), cachesize)
+        self._subs = tuple( (re.compile(k), v) for (k,v) in regular_subs.items() )
+        self._ignoretable = str.maketrans("", "", ignorechars)
+        self._cached = functools.lru_cache(maxsize=cachesize)(self._normalize)
+
+    # For pickling (worker processes): the cache can not be pickled, a copy starts with an empty one
+    def __getstate__(self): return self._settings
+    def __setstate__(self, settings): self.__init__(*settings)
+
+    def _normalize(self, s):
+        for (pattern, repl) in self._subs:
+            s = pattern.sub(repl, s)
+        s = self._whitespace.sub(" ", s) # replace more than one space with one space
+        return s.translate(self._ignoretable)
+
+    def __call__(self, s):
+        if not s or not isinstance(s,str): return s
+        return self._cached(s)
+
+    def normalize_dict(self, datadict, keys):
+        """Return normalized values for those keys (e.g. column names used by rules) found in datadict."""
+        return { k: self(datadict[k]) for k in keys if k in datadict }
+
+class LRUCache():
+    """Keeps the maxsize most recently used items, counts hits and misses. maxsize 0 = nothing is stored.
+
+    Unlike functools.lru_cache, the statistics can be collected from worker processes (pop_stats/add_stats)."""
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    def __len__(self): return len(self._data)
+    def get(self, key, default=None):
+        try: value = self._data[key]
+        except KeyError: 
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+    def put(self, key, value):
+        if self.maxsize <= 0: return
+        self._data[key] = value
+        if len(self._data) > self.maxsize: self._data.popitem(last=False) # Least recently used
+    def clear(self): self._data.clear()
+    @property
+    def hitrate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+    def pop_stats(self):
+        """Return (hits, misses) and reset the counters."""
+        stats = (self.hits, self.misses)
+        self.hits = self.misses = 0
+        return stats
+    def add_stats(self, stats):
+        self.hits += stats[0]
+        self.misses += stats[1]
+
+class Stats():
+    """Cumulative timers (seconds) and counters of a run, by name.
+
+    As LRUCache, the statistics of worker processes are collected with pop_stats/add_stats."""
+    def __init__(self):
+        self.times = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+    def add_time(self, name, seconds): self.times[name] += seconds
+    def count(self, name, n=1): self.counts[name] += n
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try: yield
+        finally: self.times[name] += time.perf_counter() - start
+    def pop_stats(self):
+        """Return (times, counts) as dicts and reset them."""
+        stats = (dict(self.times), dict(self.counts))
+        self.times.clear()
+        self.counts.clear()
+        return stats
+    def add_stats(self, stats):
+        (times, counts) = stats
+        for (k, v) in times.items(): self.times[k] += v
+        for (k, v) in counts.items(): self.counts[k] += v
+
+def threaded(iterable, maxsize=8, chunksize=250):
+    """Iterate over iterable in a background thread, at most maxsize chunks of chunksize items 
+    ahead of the consumer.
+
+    An exception in the thread is raised in the consumer. If the consumer stops early, the thread 
+    stops at its next chunk and closes the iterable."""
+    chunks = queue.Queue(maxsize)
+    stop = threading.Event()
+    def put(kind, x):
+        while not stop.is_set():
+            try: 
+                chunks.put((kind, x), timeout=0.1)
+                return True
+            except queue.Full: pass
+        return False
+    def produce():
+        try:
+            chunk = []
+            for item in iterable:
+                chunk.append(item)
+                if len(chunk) >= chunksize:
+                    if not put("items", chunk): return
+                    chunk = []
+            if put("items", chunk): put("end", None)
+        except BaseException as err: put("error", err)
+        finally:
+            if hasattr(iterable, "close"): iterable.close()
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            (kind, x) = chunks.get()
+            if kind == "items": yield from x
+            elif kind == "error": raise x
+            else: return
+    finally:
+        stop.set()
+        thread.join()
+
+import_times = {} # Module name -> seconds, for the modules imported with timed_import()
+def filehash(fp):
+    """SHA-1 of the content of file fp as a hex string, for noticing changed files. Read in blocks."""
+    h = hashlib.sha1()
+    with open(fp, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""): h.update(block)
+    return h.hexdigest()
+
+def timed_import(name):
+    """importlib.import_module() for modules imported only when needed, the time of the first import is kept in import_times."""
+    module = sys.modules.get(name)
+    if module is None:
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        import_times[name] = time.perf_counter() - start
+    return module
+
 def joinstr(x, y,  sep):
     if not x: return y
     else: return sep.join((x, y))
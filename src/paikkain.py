@@ -1,58 +1,89 @@
 # Call example:     jkgeoref setup.ini inputfile.xlsx
 # Current implementation depends on dictionaries keeping their order, which is true in Python3 
 
-import sys
-if sys.version_info >= (3, 11):
-    import tomllib
-else:
-    import tomli as tomllib
-
-import atexit,  datetime,  time,  argparse
-import jksheet
+# Modules needed only by some runs (openpyxl, tomllib, profilers, process pools) are imported 
+# where they are used, so that --help, --check-config and runs with CSV files start fast.
+import sys,  time
+_lap = time.perf_counter() # For --startup-times
+
+import atexit,  datetime,  argparse,  types,  collections,  traceback,  csv,  codecs,  json
+import socketserver,  threading,  stat,  signal,  os,  queue
+import jksheet,  jkstate,  jktools,  jkspatial,  jklog
 from jkerror import jkError
 from jktest import known_test_types 
-from jktools import joinstr,  my2str
-from openpyxl.styles import PatternFill
+from jktools import joinstr,  my2str,  Normalizer,  threaded
 from pathlib import Path
 import logging
 progname = 'paikkain'
 version = '3.0'
 
+startup_times = {} # Startup phase -> seconds, see lap()
+def lap(phase):
+    """Record the time since the previous lap() as the time of a startup phase."""
+    global _lap
+    now = time.perf_counter()
+    startup_times[phase] = now - _lap
+    _lap = now
+lap("imports")
+
 starttime = time.time()
 log = None # Overidden by the createlogger() call
 op_replaced = 1
 op_appended = 2
 _SUPPRESS_FILE_CREATION_FOR_TESTING = False
 first_data_line_of_geodata = 4
+parallel_chunk_rows = 250 # Input rows sent to a worker process at a time
+progress_interval = 10 # Seconds between "Processing row" messages
+profile_top = 40 # Functions listed in profile summaries
+default_coordinate_columns = ["MYGathering[0][MYLatitude]", "MYGathering[0][MYLongitude]", 
+    "MYGathering[0][MYCoordinateSystem]", "MYGathering[0][MYCoordinateRadius]"]
+pipeline_queue_chunks = 8 # Chunks of rows waiting between the reading, matching and writing stages
+pipeline_chunk_rows = 250 # Rows passed between the stages at a time
+
+rowlog = logging.getLogger(progname + ".rows") # Per-row information for --row-log, see process_row()
+_logwriter = None
 
 def createlogger(fn):
+    """Log to file fn (all messages) and the console (info and above), written by a background thread."""
+    global _logwriter
     logger = logging.getLogger(progname)
     logger.setLevel(logging.DEBUG)
-    fh = logging.FileHandler(fn)
-    ch = logging.StreamHandler()
+    fh = jklog.FileHandler(fn)
+    ch = jklog.StreamHandler()
+    ch.setLevel(logging.INFO) # Per-row messages would slow down large runs on some consoles
     formatter = logging.Formatter('%(message)s [%(levelname)s]')
     fh.setFormatter(formatter)
     ch.setFormatter(formatter)
-    logger.addHandler(fh)
-    logger.addHandler(ch)   
+    _logwriter = jklog.BackgroundLogging(logger, [fh, ch])
+    rowlog.propagate = False # Written to the row log file only
     return logger
 
 class WriteRow(Exception): pass
 
 def onexit(): 
     if log: log.info("Done")
-    if ( ('outdata' in dir()) and  outdata ) : outdata.close()
-    if ( ('geodata' in dir()) and  geodata ) : geodata.close()
-    if ( ('indata' in dir()) and  indata ) : indata.close()
     endtime = time.time()
     if log: log.info("Time spent: %-.2f s" % (endtime - starttime) )
+    if _logwriter: _logwriter.stop()
 
 def create_output_name(infn, addition):
     infn = Path(infn)
     return infn.with_suffix(f".{addition}" + infn.suffix)
 
-def read_TOML_config(confname):
+def csv_options(section):
+    """CSV reader/writer options from a config file section: csv_encoding, csv_dialect, csv_delimiter."""
+    opts = { 'encoding': section.get('csv_encoding', "utf-8-sig"), 'dialect': section.get('csv_dialect', "excel") }
+    if 'csv_delimiter' in section: opts['delimiter'] = section['csv_delimiter']
+    try: codecs.lookup(opts['encoding'])
+    except LookupError: raise jkError(f"Unknown CSV encoding {opts['encoding']}.")
+    if opts['dialect'] not in csv.list_dialects(): 
+        raise jkError(f"Unknown CSV dialect {opts['dialect']}, known dialects are {', '.join(csv.list_dialects())}.")
+    return opts
+
+def read_TOML_config(conffn):
     """Read a configuration file in TOML. Raise a jkError on error."""    
+    if sys.version_info >= (3, 11): import tomllib
+    else: import tomli as tomllib
     if not conffn.is_file(): raise jkError(f"Config file '{conffn.absolute()}' does not exist or if not readable.")    
     try:
         with conffn.open("rb") as f: config = tomllib.load(f)
@@ -61,211 +92,827 @@ def read_TOML_config(confname):
     pm = config.get("programname","")
     ver = config.get("version","")
     if not "filenames" in config["knowndatafiles"]: raise ValueError("Config file has no knowndatafiles:filenames item.")
-    file = config["knowndatafiles"]["filenames"][0]    
+    file = ", ".join(config["knowndatafiles"]["filenames"])
     config["outputfiles"]["transcribernote"] = config["outputfiles"]["transcribernote"].replace("{programname}", pm)
     config["outputfiles"]["transcribernote"] = config["outputfiles"]["transcribernote"].replace("{version}", ver)
     config["outputfiles"]["transcribernote"] = config["outputfiles"]["transcribernote"].replace("{knowndatafiles:filenames}", file)    
     return config    
 
+#  ------------------ processing of input rows
+
+def skip_row(origdict, rowcount, s):
+    """True if the input row is written out without matching."""
+    if rowcount < s.first_data_line: # If this is a header line, just write
+        return True
+    # If line has content in specified columns already, skip
+    for skipname in s.skip_if_content_columnnames:
+        val = str(origdict.get(skipname,""))
+        if val and val.strip(): # Has some content
+            return True
+    return False
+
+def process_row(origdict, rowcount, outcolnames, geodataset, normalizer, s, matchrows=None):
+    """Return the output row for an input row as (outdict, edited).
+
+    outcolnames = lowercase column names of the output file, s = settings from the config file.
+    matchrows = matches found already (by the batch engine), if not given they are searched here.
+    Counts and time spent (apart from matching) are added to geodataset.stats."""
+    start = time.perf_counter()
+    stats = geodataset.stats
+    outdict =  origdict.copy()
+    edited = { k: False for k in outdict.keys() } # Edit status for each item on this row
+    try:
+        if skip_row(origdict, rowcount, s):
+            if rowcount >= s.first_data_line: 
+                stats.counts["skipped"] += 1
+                # Rows with coordinates are usually skipped, they are matched for the check only
+                if s.coordinate_check_column: start += add_coordinate_check(outdict, edited, origdict, None, geodataset, normalizer, s)
+            raise WriteRow
+        if matchrows is None:
+            matchstart = time.perf_counter()
+            matchrows = geodataset.find_matches( origdict, normalizer ) # (GeoData, row number) pairs
+            start += time.perf_counter() - matchstart # Timed by find_matches
+        if s.coordinate_check_column: add_coordinate_check(outdict, edited, origdict, matchrows, geodataset, normalizer, s)
+        nmatch = len(matchrows)
+        if s.row_log: rowlog.info("", extra={"row": {"row": rowcount, "matches": nmatch, 
+            "known": [ [gd.filename.name, n] for (gd, n) in matchrows ]}})
+        if nmatch == 0:
+            stats.counts["no_match"] += 1
+            if s.diagnostics_column: add_diagnosis(outdict, edited, origdict, matchrows, geodataset, normalizer, s)
+            raise WriteRow
+        if nmatch > 1:
+            stats.counts["multiple_matches"] += 1
+            if s.diagnostics_column: add_diagnosis(outdict, edited, origdict, matchrows, geodataset, normalizer, s)
+            raise WriteRow
+        # OK, so we have exactly one match
+        stats.counts["unique_match"] += 1
+        originaldata = [] # Kept to store original data from cells that may be replaced (for later reporting in the output)
+        (matchdata, mrow) = matchrows[0] # file and index of the single matching row
+        # Output of the matching row: (colname, operation, value) for the columns of outdata,
+        # values with the overrule marker in known_data already left out
+        for (colname, oper, val) in geodataset.output_items(matchdata, mrow, outcolnames, s.activeops, s.outputops, s.knownd_keep):
+            # Copy original data to a field in the output file (not copying the output cell data into itself
+            if s.append_original_geodata_to_column and (colname != s.append_original_geodata_to_column):
+                oval = origdict.get(colname,"")
+                if oval: originaldata.append(oval)
+            # OK to here
+            if oper is None:
+                continue # Skip column with actions that are not output operations
+            elif (oper == s.cmd_replace) or ( oper == s.cmd_fillempty and not outdict[colname] ):
+                outdict[colname] = val
+                edited[colname] = op_replaced
+            elif oper == s.cmd_append and val: # Append non-empty values only
+                outdict[colname] = joinstr( outdict.get(colname,"" ),  val ,  s.itemsep )
+                edited[colname] = op_appended
+        if s.append_original_geodata_to_column: # Append old data to designated cell
+                origstr = f"{s.original_geodata_header} {s.itemsep.join(originaldata)}"
+                cn = s.append_original_geodata_to_column.lower()
+                outdict[cn] = joinstr(outdict.get(cn,"" ),  origstr ,  "")
+                edited[cn] = True
+        if s.matched_file_column: # Report which known data file was used
+            cn = s.matched_file_column.lower()
+            outdict[cn] = matchdata.filename.name
+            edited[cn] = True
+        # Add note by the program, if available
+        if s.pnotecolname and s.pnote:
+            cn = s.pnotecolname.lower()
+            outdict[cn] = joinstr(outdict.get(cn,"" ),  s.pnote ,  s.itemsep)
+            edited[cn] = True
+        raise WriteRow
+    except WriteRow:
+        stats.times["apply"] += time.perf_counter() - start
+        return (outdict, edited)
+
+def add_diagnosis(outdict, edited, origdict, matchrows, geodataset, normalizer, s):
+    """Write why the row was not georeferenced to the diagnostics column."""
+    cn = s.diagnostics_column.lower()
+    outdict[cn] = geodataset.diagnose(origdict, matchrows, normalizer)
+    edited[cn] = True
+
+def add_coordinate_check(outdict, edited, origdict, matchrows, geodataset, normalizer, s):
+    """Write how the coordinates of the row agree with the known data to the coordinate check column.
+    Rows without coordinates are left as they are.
+
+    matchrows = matches of the row, searched here if None. Returns the time spent searching them."""
+    try: 
+        point = jkspatial.parse_point(*( my2str(origdict.get(cn.lower())) for cn in s.coordinate_columns ))
+        if point is None: return 0.0
+    except ValueError as err: 
+        check = f"Coordinates not understood: {err}."
+        matchseconds = 0.0
+    else:
+        matchstart = time.perf_counter()
+        if matchrows is None: matchrows = geodataset.find_matches(origdict, normalizer)
+        matchseconds = time.perf_counter() - matchstart
+        (check, far) = geodataset.check_coordinates(point, matchrows, s.coordinate_check_distance)
+        geodataset.stats.counts["coordinates_checked"] += 1
+        if far: geodataset.stats.counts["coordinates_far"] += 1
+    cn = s.coordinate_check_column.lower()
+    outdict[cn] = check
+    edited[cn] = True
+    return matchseconds
+
+# Parallel processing: worker processes get the known data and settings once, and input rows in chunks.
+# Their log messages are sent back with the results, and logged in input row order.
+_worker = None
+
+class _RecordCollector(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+    def emit(self, record):
+        record.msg = record.getMessage() # Arguments may not be picklable
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+def _init_worker(geodataset, normalizer, s):
+    global _worker, log
+    log = logging.getLogger(progname)
+    for h in list(log.handlers): log.removeHandler(h) # Inherited from parent if forked
+    log.setLevel(logging.DEBUG)
+    collector = _RecordCollector()
+    log.addHandler(collector)
+    for h in list(rowlog.handlers): rowlog.removeHandler(h) # Row log file of the parent, if forked
+    rowlog.propagate = True # To the collector, the parent process writes the row log
+    geodataset.pop_stats() # Counted in the parent process already
+    _worker = types.SimpleNamespace(geodataset=geodataset, normalizer=normalizer, settings=s, collector=collector)
+
+def process_chunk(chunk, outcolnames, geodataset, normalizer, s, state=None):
+    """Process a list of (rowcount, origdict) pairs, return a list of (outdict, edited). 
+
+    With the batch engine, the rows of the chunk are matched all at once. 
+    state = a jkstate.IncrementalState, for reusing the results of the previous run."""
+    if s.match_engine != "batch" and not state: 
+        return [ process_row(origdict, rowcount, outcolnames, geodataset, normalizer, s) for (rowcount, origdict) in chunk ]
+    tomatch = [ not skip_row(origdict, rowcount, s) for (rowcount, origdict) in chunk ]
+    datadicts = [ origdict for ((rowcount, origdict), m) in zip(chunk, tomatch) if m ]
+    if state: found = iter(state.find_matches(datadicts, normalizer, s.match_engine == "batch"))
+    else: found = iter(geodataset.find_matches_batch(datadicts, normalizer))
+    return [ process_row(origdict, rowcount, outcolnames, geodataset, normalizer, s, next(found) if m else None) 
+        for ((rowcount, origdict), m) in zip(chunk, tomatch) ]
+
+def _process_chunk(outcolnames, chunk):
+    results = process_chunk(chunk, outcolnames, _worker.geodataset, _worker.normalizer, _worker.settings)
+    records = _worker.collector.records
+    _worker.collector.records = []
+    return (results, records, _worker.geodataset.pop_stats())
+
+def _chunks(rows, n):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= n:
+            yield chunk
+            chunk = []
+    if chunk: yield chunk
+
+def process_rows_parallel(pool, nworkers, rows, outcolnames, geodataset, chunkrows=parallel_chunk_rows):
+    """Process (rowcount, origdict) pairs on a process pool, yield (outdict, edited) in input order.
+
+    Statistics of the workers are added to geodataset.stats."""
+    pending = collections.deque()
+    def results(future):
+        (chunkresults, records, stats) = future.result()
+        for record in records: logging.getLogger(record.name).handle(record) # Row log records to rowlog
+        geodataset.add_stats(stats)
+        return chunkresults
+    for chunk in _chunks(rows, chunkrows):
+        pending.append( pool.submit(_process_chunk, outcolnames, chunk) )
+        if len(pending) >= 2*nworkers: # Keep the number of rows in memory bounded
+            yield from results(pending.popleft())
+    while pending:
+        yield from results(pending.popleft())
+
+def _process_file_job(infn):
+    """Process one input file in a worker process, return (error message or None, log records, statistics)."""
+    error = None
+    try:
+        process_file(infn, _worker.geodataset, _worker.normalizer, _worker.settings)
+    except (jkError,  FileNotFoundError,  ValueError,  OSError) as msg: 
+        log.critical(msg)
+        error = str(msg)
+    except Exception as err: # One failed file must not stop the others
+        log.critical(traceback.format_exc())
+        error = f"{type(err).__name__}: {err}"
+    records = _worker.collector.records
+    _worker.collector.records = []
+    return (error, records, _worker.geodataset.pop_stats())
+
+def _write_output(outdata, chunks, done, save=True):
+    """Writer process of the pipeline: write the lists of (outdict, edited) from queue chunks to 
+    outdata until None, then close it. Puts (error message or None, time spent writing) to queue done."""
+    (error, seconds) = (None, 0.0)
+    for chunk in iter(chunks.get, None):
+        if error: continue # Read to the end, so that the sender is not blocked
+        start = time.perf_counter()
+        try:
+            for (outdict, edited) in chunk:
+                outdata.itersetrow(outdict,  edited)
+                next(outdata) # Move to next line in outdata
+        except Exception as err: error = f"{type(err).__name__}: {err}"
+        seconds += time.perf_counter() - start
+    if not error and save:
+        start = time.perf_counter()
+        try: outdata.close()
+        except Exception as err: error = f"{type(err).__name__}: {err}"
+        seconds += time.perf_counter() - start
+    done.put((error, seconds))
+
+class _OutputWriter():
+    """Writes outdata (not yet started) in a process of its own, rows are sent to it in chunks
+    through a bounded queue. The caller must not use outdata after this."""
+    def __init__(self, outdata, save=True):
+        self.fp = outdata.filename
+        import multiprocessing
+        self.chunks = multiprocessing.Queue(pipeline_queue_chunks)
+        self.done = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=_write_output, args=(outdata, self.chunks, self.done, save), daemon=True)
+        self.process.start()
+    def _wait(self, f):
+        while True:
+            try: return f(timeout=1)
+            except (queue.Full, queue.Empty): 
+                if not self.process.is_alive(): raise jkError(f"Writing {self.fp} failed: writer process stopped")
+    def put(self, chunk): self._wait(lambda timeout: self.chunks.put(chunk, timeout=timeout))
+    def close(self):
+        """Wait until the output is written, return the time spent writing."""
+        self.put(None)
+        (error, seconds) = self._wait(self.done.get)
+        self.process.join()
+        if error: raise jkError(f"Writing {self.fp} failed: {error}")
+        return seconds
+    def terminate(self):
+        if self.process.is_alive(): self.process.terminate()
+
+def read_rows(indata, stats=None):
+    """Yield (row number, row as dict) for the rows after the header line.
+
+    Rows read and time spent are added to stats (a jktools.Stats), if given."""
+    rowcount = 2
+    started = lastprogress = time.perf_counter()
+    while not indata.end():
+        start = time.perf_counter()
+        if start - lastprogress >= progress_interval:
+            log.info(f"Processing row {rowcount} ({(rowcount - 2) / (start - started):.0f} rows/s)")
+            lastprogress = start
+        row = indata.next_row_as_dict()
+        if stats: 
+            stats.times["read"] += time.perf_counter() - start
+            stats.counts["rows"] += 1
+        yield (rowcount, row)
+        rowcount += 1
+
+def add_output_columns(outdata, firstrow, geodataset, s):
+    """Set up the columns of the output file: input file columns (firstrow) and those added by the 
+    config or known data if not in the input."""
+    for name in firstrow[::-1]:  # Grab first row. Reverse order to as insertion re-reverses them
+        outdata.addcolumn(1,  [name])                
+    for colname in geodataset.output_column_names(s.activeops)[::-1]:  # Reverse order to as insertion re-reverses them
+        if not outdata.hascolumn(colname):
+            log.info(f"adding column {colname} to output table")
+            outdata.addcolumn(s.new_field_insert_point,  [colname])
+    if s.pnotecolname and s.pnote:
+        if not outdata.hascolumn(s.pnotecolname):
+            log.info(f"adding column {s.pnotecolname} to output table")
+            outdata.addcolumn(s.new_field_insert_point, [s.pnotecolname])
+    if s.matched_file_column:
+        if not outdata.hascolumn(s.matched_file_column):
+            log.info(f"adding column {s.matched_file_column} to output table")
+            outdata.addcolumn(s.new_field_insert_point, [s.matched_file_column])
+    if s.diagnostics_column:
+        if not outdata.hascolumn(s.diagnostics_column):
+            log.info(f"adding column {s.diagnostics_column} to output table")
+            outdata.addcolumn(s.new_field_insert_point, [s.diagnostics_column])
+    if s.coordinate_check_column:
+        if not outdata.hascolumn(s.coordinate_check_column):
+            log.info(f"adding column {s.coordinate_check_column} to output table")
+            outdata.addcolumn(s.new_field_insert_point, [s.coordinate_check_column])
+    if s.append_original_geodata_to_column:
+        if not outdata.hascolumn(s.append_original_geodata_to_column):
+            log.info(f"adding column {s.append_original_geodata_to_column} to output table")
+            outdata.addcolumn(s.new_field_insert_point ,  [s.append_original_geodata_to_column]) 
+
+def process_file(infn, geodataset, normalizer, s, pool=None, nworkers=1, pipeline=None):
+    """Georeference one input file, return the output file name. Raises an exception if the file cannot be processed.
+
+    With pipeline, rows are read in a thread and written in a process of their own while the 
+    rows read earlier are matched, with a bounded number of rows waiting between the stages.
+    By default used if there is more than one CPU, on one CPU the stages would only take turns."""
+    if pipeline is None: pipeline = (os.cpu_count() or 1) > 1
+    log.info(f"\n\nProcessing file {infn}") 
+    # OPEN INPUT DATA
+    if Path(infn).suffix.lower() in jksheet.csv_suffixes:
+        indata = jksheet.roCSV(infn, s.first_data_line, **s.csv_in)
+    else:
+        indata = jksheet.roExcel(infn, s.first_data_line)            
+    (rows, writer, rowloghandler, outdata, saved) = (None, None, None, None, False)
+    try:
+        # SETUP FOR OUTPUT FILE
+        outfn = create_output_name(infn, s.output_marker)        
+        if s.outputformat == 'fast-xlsx': 
+            outfn = outfn.with_suffix(".out.xlsx") 
+            outdata = jksheet.woExcel(outfn, s.first_data_line)
+            outdata.fill_edited_color("fa867e")
+        elif s.outputformat == 'csv':
+            outfn = outfn.with_suffix(".out.csv") 
+            outdata = jksheet.woCSV(outfn, s.first_data_line, **s.csv_out)
+        else:
+            raise jkError(f"Unknown output format {s.outputformat}.")
+        state = None
+        if s.incremental: # Output and state file of the previous run are replaced
+            statefn = jkstate.statefile_for(outfn)
+            if outfn.exists() and not statefn.exists(): 
+                raise jkError(f"File {outfn} exists but its state file {statefn.name} does not. Will not overwrite.")
+            state = jkstate.IncrementalState(statefn, geodataset, match_settings(s))
+            (input_hash, outsettings) = (jktools.filehash(infn), output_settings(s))
+            if outfn.exists() and state.up_to_date(input_hash, outsettings):
+                log.info(f"Output file {outfn} is up to date")
+                return outfn
+        elif outfn.exists(): 
+            raise jkError(f"File {outfn} exists. Will not overwrite.")
+
+        if s.row_log:
+            rowloghandler = jklog.RowLog(create_output_name(infn, s.output_marker).with_suffix(".rows.jsonl"))
+            rowlog.addHandler(rowloghandler)
+            (propagate, rowlog.propagate) = (rowlog.propagate, False)
+        firstrow = indata.next_row()
+        # Verify that 1st line is valid
+        for i in range(len(firstrow)):
+            if not firstrow[i]: 
+                raise ValueError(f"File {indata.filename}, column {i+1}: Empty column name (first row) not allowed.")
+
+        add_output_columns(outdata, firstrow, geodataset, s)
+
+        # Step through input file and process line by line
+        # 1st line (header line) has already been read
+        outcolnames = frozenset(outdata.lowercolnames)
+        stats = geodataset.stats
+        if pipeline: writer = _OutputWriter(outdata, not _SUPPRESS_FILE_CREATION_FOR_TESTING) # Before starting threads
+        rows = read_rows(indata, stats)
+        if pipeline: rows = threaded(rows, pipeline_queue_chunks, pipeline_chunk_rows)
+        if state:
+            chunkrows = s.batch_size if s.match_engine == "batch" else parallel_chunk_rows
+            results = ( result for chunk in _chunks(rows, chunkrows)
+                for result in process_chunk(chunk, outcolnames, geodataset, normalizer, s, state) )
+        elif pool:
+            chunkrows = s.batch_size if s.match_engine == "batch" else parallel_chunk_rows
+            results = process_rows_parallel(pool, nworkers, rows, outcolnames, geodataset, chunkrows)
+        elif s.match_engine == "batch":
+            results = ( result for chunk in _chunks(rows, s.batch_size)
+                for result in process_chunk(chunk, outcolnames, geodataset, normalizer, s) )
+        else:
+            results = ( process_row(origdict, rowcount, outcolnames, geodataset, normalizer, s)
+                for (rowcount, origdict) in rows )
+        if pipeline:
+            for chunk in _chunks(results, pipeline_chunk_rows):
+                with stats.timer("write_wait"): writer.put(chunk)
+            log.info(f"Saving output file {outfn}")
+            with stats.timer("write_wait"): stats.add_time("write", writer.close())
+            (writer, saved) = (None, True)
+        else:
+            for (outdict, edited) in results:
+                start = time.perf_counter()
+                outdata.itersetrow(outdict,  edited)
+                next(outdata) # Move to next line in outdata
+                stats.times["write"] += time.perf_counter() - start
+            log.info(f"Saving output file {outfn}")
+            if not _SUPPRESS_FILE_CREATION_FOR_TESTING:
+                with stats.timer("write"): outdata.close()
+                saved = True
+        if state:
+            state.save(input_hash, outsettings)
+            stats.count("reused", state.reused)
+            if state.loaded: log.info(f"Earlier match results used for {state.reused} rows, rule column values changed on {state.changed_rows()} rows since the last run")
+    finally:
+        if rows: rows.close() # Stops the reader thread
+        if writer: writer.terminate()
+        if outdata and not saved: outdata.discard() # Failed, or not saved for testing
+        if rowloghandler:
+            rowlog.removeHandler(rowloghandler)
+            rowloghandler.close()
+            rowlog.propagate = propagate
+        indata.close()
+    return outfn
+
+def profile_file(infn, geodataset, normalizer, s, mode="cprofile"):
+    """process_file() with a profiler. If the file is processed, the profile and a summary, with time spent by each rule, 
+    are written next to the output file (.prof and .profile.txt).
+
+    mode = cprofile or sampling (pyinstrument, if installed)."""
+    import cProfile,  pstats
+    if mode == "sampling":
+        try: import pyinstrument
+        except ImportError: raise jkError("Sampling profiler needs pyinstrument (pip install pyinstrument), or use --profile cprofile.")
+        profiler = pyinstrument.Profiler()
+        (start, stop) = (profiler.start, profiler.stop)
+    else:
+        profiler = cProfile.Profile()
+        (start, stop) = (profiler.enable, profiler.disable)
+    base = create_output_name(infn, s.output_marker)
+    geodataset.start_rule_timing()
+    start()
+    try: 
+        outfn = process_file(infn, geodataset, normalizer, s, pipeline=False) # Profilers see the main thread only
+    finally:
+        stop()
+        ruletimes = geodataset.stop_rule_timing()
+    # Written only if the file was processed, a failed run would replace an earlier profile
+    summaryfn = base.with_suffix(".profile.txt")
+    with open(summaryfn, "w", encoding="utf-8") as f:
+        f.write(f"Profile of {infn} ({mode})\n\n")
+        write_rule_times(f, ruletimes)
+        if mode == "sampling": 
+            profiler.last_session.save(base.with_suffix(".pyisession"))
+            f.write(profiler.output_text(unicode=True, color=False))
+        else:
+            profiler.dump_stats(base.with_suffix(".prof"))
+            f.write(f"Top {profile_top} functions by cumulative time:\n")
+            pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(profile_top)
+    log.info(f"Profile written to {summaryfn}")
+    return outfn
+
+def write_rule_times(f, ruletimes):
+    """Write time spent in the tests of each rule type and known data column to a text file f. 
+    ruletimes from GeoDataSet.stop_rule_timing()."""
+    bytype = collections.defaultdict(lambda: [0, 0.0])
+    for (gd, rule, tests, seconds) in ruletimes:
+        bytype[rule.type][0] += tests
+        bytype[rule.type][1] += seconds
+    f.write("Rule tests by rule type (looking up candidate rows in the index is not included):\n")
+    for (ruletype, (tests, seconds)) in sorted(bytype.items(), key=lambda x: -x[1][1]):
+        f.write(f"  {ruletype:12s} {tests:12d} tests {seconds:10.3f} s\n")
+    f.write("\nRule tests by known data column:\n")
+    for (gd, rule, tests, seconds) in sorted(ruletimes, key=lambda x: -x[3]):
+        f.write(f"  {gd.filename.name} column {rule.col + 1} {rule.colname} ({rule.type}): {tests} tests {seconds:.3f} s\n")
+    f.write("\n")
+
+#  ------------------ resident service
+
+# The service reads requests as JSON objects, one per line, and answers each with one line of JSON:
+#   {"match": {column name: value, ...}}  georeference one row (known data output, as it would be written to an output file)
+#   {"files": [input file name, ...]}     process input files as given on the command line
+# An "id" given in a request is returned in its answer. Answers have "ok": true, or "ok": false and an "error".
+default_service_address = "localhost:8765"
+
+class _ServiceHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip(): continue
+            request = None
+            try:
+                request = json.loads(line)
+                with self.server.lock: # Caches of the known data are not thread safe
+                    answer = service_request(request, *self.server.job)
+            except Exception as err: 
+                log.error(f"Service request failed: {type(err).__name__}: {err}")
+                answer = {"ok": False, "error": f"{type(err).__name__}: {err}"}
+                if isinstance(request, dict) and "id" in request: answer["id"] = request["id"]
+            self.wfile.write( (json.dumps(answer, default=str) + "\n").encode("utf-8") )
+
+class _TCPService(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"): 
+    class _UnixService(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+def service_request(request, geodataset, normalizer, s):
+    """Answer one service request (a dict), see above."""
+    request = dict(request) if isinstance(request, dict) else {}
+    answer = {"ok": True}
+    if "id" in request: answer["id"] = request["id"]
+    if "match" in request:
+        answer.update(match_one_row(request["match"], geodataset, normalizer, s))
+    elif "files" in request:
+        answer["results"] = []
+        for infn in request["files"]:
+            try:
+                outfn = process_file(Path(infn), geodataset, normalizer, s)
+                answer["results"].append({"file": str(infn), "output": str(outfn)})
+            except (jkError,  FileNotFoundError,  ValueError,  OSError) as msg:
+                log.critical(msg)
+                answer["results"].append({"file": str(infn), "error": str(msg)})
+            except Exception as err: # One failed file must not stop the others
+                log.critical(traceback.format_exc())
+                answer["results"].append({"file": str(infn), "error": f"{type(err).__name__}: {err}"})
+        answer["ok"] = all( "error" not in r for r in answer["results"] )
+    else: raise jkError("Unknown request, should have 'match' or 'files'")
+    return answer
+
+def match_one_row(row, geodataset, normalizer, s):
+    """Georeference one row (dict of column name: value) as process_row() does for input files, 
+    return a dict with the result, the matches and the values of the edited columns."""
+    if not isinstance(row, dict): raise jkError("A match request should be a JSON object of column names and values")
+    names = { n.lower(): n for n in geodataset.output_column_names(s.activeops) }
+    for n in [s.pnotecolname if s.pnote else None, s.matched_file_column, s.diagnostics_column, s.append_original_geodata_to_column]:
+        if n: names[n.lower()] = n
+    names.update( (str(k).lower(), str(k)) for k in row )
+    origdict = dict.fromkeys(names, "")
+    origdict.update( (str(k).lower(), "" if v is None else v) for (k, v) in row.items() )
+    rowcount = s.first_data_line
+    if skip_row(origdict, rowcount, s): 
+        (result, matchrows) = ("skipped", ())
+    else:
+        matchrows = geodataset.find_matches(origdict, normalizer)
+        result = { 0: "no_match", 1: "unique_match" }.get(len(matchrows), "multiple_matches")
+    (outdict, edited) = process_row(origdict, rowcount, frozenset(names), geodataset, normalizer, s, matchrows)
+    return { "result": result, 
+        "matches": [ {"file": gd.filename.name, "row": n} for (gd, n) in matchrows ], 
+        "row": { names[k]: v for (k, v) in outdict.items() if edited.get(k) } }
+
+def _stop_service(signum, frame): raise KeyboardInterrupt
+
+def serve(address, geodataset, normalizer, s):
+    """Serve requests on address (host:port, or unix:path for a Unix socket) until interrupted."""
+    if address.startswith("unix:"):
+        if not hasattr(socketserver, "ThreadingUnixStreamServer"): raise jkError("Unix sockets are not supported on this system")
+        path = Path(address[5:])
+        if path.exists() and stat.S_ISSOCK(path.stat().st_mode): path.unlink() # Left over from an earlier service
+        server = _UnixService(str(path), _ServiceHandler)
+    else:
+        (host, sep, port) = address.rpartition(":")
+        try: server = _TCPService((host or "localhost", int(port)), _ServiceHandler)
+        except ValueError: raise jkError(f"Bad service address {address}, should be host:port or unix:path")
+    server.job = (geodataset, normalizer, s)
+    server.lock = threading.Lock()
+    signal.signal(signal.SIGTERM, _stop_service)
+    log.info(f"Serving on {address}, stop with Ctrl-C")
+    try: server.serve_forever()
+    except KeyboardInterrupt: log.info("Service stopped")
+    finally: 
+        server.server_close()
+        if address.startswith("unix:"): Path(address[5:]).unlink(missing_ok=True)
+
+#  ------------------ settings and known data
+
+def match_settings(s):
+    """Settings the match results depend on, for incremental runs (see jkstate)."""
+    return (version, s.ignorechars, tuple(s.regular_subs.items()), s.knownd_search, known_test_types, first_data_line_of_geodata)
+
+def output_settings(s):
+    """All settings, for checking if an output file is up to date in incremental runs."""
+    return (version, repr(sorted( (k, v) for (k, v) in vars(s).items() if k != 'incremental' )))
+
+def read_settings(c):
+    """Settings from the config file data c (see read_TOML_config) as a namespace. 
+
+    These are needed for processing files and rows, also in worker processes."""
+    # Regular expression replacements
+    if 'replacements' in c['inputfiles']:
+        regular_subs = c['inputfiles']['replacements']
+    else: regular_subs = {}
+    match_engine = c['knowndatafiles'].get('match_engine', "rows")
+    if match_engine not in ["rows", "batch"]: raise jkError(f"Unknown match_engine {match_engine}, should be rows or batch.")
+    try:
+        cmd_replace = c['knowndatafiles']['cmd_replace']
+        cmd_append = c['knowndatafiles']['cmd_append']
+        cmd_fillempty = c['knowndatafiles']['cmd_fillempty']
+        cmd_nothing = c['knowndatafiles']['cmd_nothing']
+    except LookupError as msg: raise jkError(f"Command names must be defined in the config file: {msg}.")
+    knownd_filenames = [ Path(x) for x in  c['knowndatafiles'].get('filenames') ]  
+
+    pnote = c['outputfiles'].get('transcribernote', "") 
+    if c['outputfiles'].get('transcribernote_appendfilenames', False):
+        pnote += " "
+        pnote += ", ".join((str(x) for x in knownd_filenames) )
+    if c['outputfiles'].get('add_date_to_note'):
+        pnote = pnote + " (%s)" % datetime.date.today()
+    outputformat = c['outputfiles'].get('output_format')
+    outputformat = outputformat.lower()
+    if outputformat not in ['csv', 'xlsx',  'fast-xlsx']: 
+        raise jkError(f"Unknown output format: {outputformat.upper()}")
+    pnotecolname = None
+    if pnote: pnotecolname = c['outputfiles'].get('transcribernotefield')
+
+    skip_if_content_columnnames = c['inputfiles'].get('skip_if_nonempty',[]) # Empty list default
+    skip_if_content_columnnames = [x.lower() for x in skip_if_content_columnnames]
+    log.debug(f"skipping row if content if found in columns {skip_if_content_columnnames}")
+
+    return types.SimpleNamespace( 
+        # Input files and comparison
+        first_data_line = c['inputfiles'].get('first_data_line', 2),
+        csv_in = csv_options(c['inputfiles']),
+        ignorechars = c.get('ignore_in_comparison',""),
+        regular_subs = regular_subs,
+        skip_if_content_columnnames = skip_if_content_columnnames, 
+        # Known data
+        knownd_filenames = knownd_filenames,
+        knownd_sheetnames = c['knowndatafiles'].get('sheetname',None),
+        knownd_keep = c['knowndatafiles'].get('keep_original_data_marker').lower(),
+        knownd_use_cache = c['knowndatafiles'].get('use_cache', True),
+        knownd_search = c['knowndatafiles'].get('search', "cascade"),
+        knownd_cachesize = c['knowndatafiles'].get('result_cache_size', 10000),
+        match_engine = match_engine, 
+        batch_size = c['knowndatafiles'].get('batch_size', 100000),
+        outputops = [cmd_replace, cmd_append, cmd_fillempty, cmd_nothing], 
+        activeops = [cmd_replace, cmd_append, cmd_fillempty], 
+        cmd_replace = cmd_replace, cmd_append = cmd_append, cmd_fillempty = cmd_fillempty, 
+        # Output files
+        output_marker = c['outputfiles'].get('filename_add'),
+        outputformat = outputformat, 
+        csv_out = csv_options(c['outputfiles']),
+        new_field_insert_point = c['outputfiles'].get('new_column_insertion_position'),
+        itemsep = c['outputfiles'].get('data_append_connector') + " ", 
+        original_geodata_header = c['outputfiles'].get('original_geodata_to_column_header'),
+        append_original_geodata_to_column = c['outputfiles'].get('append_original_geodata_to_column',None),
+        matched_file_column = c['outputfiles'].get('matched_file_column', None), 
+        diagnostics_column = c['outputfiles'].get('diagnostics_column', None), 
+        coordinate_check_column = c['outputfiles'].get('coordinate_check_column', None), 
+        coordinate_check_distance = c['outputfiles'].get('coordinate_check_distance', 5000), 
+        coordinate_columns = c['outputfiles'].get('coordinate_columns', default_coordinate_columns), 
+        pnote = pnote, pnotecolname = pnotecolname,
+        incremental = False, # Set by --incremental
+        row_log = False ) # Set by --row-log
+
+def load_geodata(s):
+    """Read the known data files of settings s, return a jksheet.GeoDataSet."""
+    start = time.perf_counter()
+    geodatalist = []
+    for knowdatafn in s.knownd_filenames:
+        log.info(f"Loading geodata from file {knowdatafn}")
+        geodata = jksheet.GeoData.fromfile(Path(knowdatafn), 
+            s.knownd_sheetnames, 
+            first_data_line_of_geodata,
+            use_cache=s.knownd_use_cache,
+            cache_settings=(s.ignorechars, tuple(s.regular_subs.items())) )     
+        log.debug("Parsing rules from geodata file headers")
+        rules = geodata.parse_rules(known_test_types) # Parse row matching rules from GeoData file header rows
+        geodata.update_cache()
+        geodatalist.append( geodata )
+        #log.debug(f"Found the following test rules:")
+        for rule in rules: log.info(f"Rule for column {rule.colname}, rule type '{rule.type}'")
+    geodataset = jksheet.GeoDataSet(geodatalist, known_test_types, s.knownd_search, s.knownd_cachesize)
+    if len(geodataset) > 1: log.info(f"Searching {len(geodataset)} known data files, search mode '{s.knownd_search}'")
+    if s.match_engine == "batch": 
+        log.info(f"Using the batch matching engine, {s.batch_size} rows at a time")
+        geodataset.prepare_batch() # Before worker processes are started, so they get a copy
+    if s.diagnostics_column: 
+        log.info("Indexing known data values for diagnostics")
+        geodataset.prepare_suggestions()
+    if s.coordinate_check_column: 
+        log.info("Indexing known data coordinates")
+        log.info(f"{len(geodataset.prepare_coordinates(s.coordinate_columns))} known data rows with coordinates")
+    geodataset.stats.add_time("load", time.perf_counter() - start)
+    return geodataset
+
+def write_startup_times():
+    """Log startup_times (see lap()) and the modules imported when needed, in the style of python -X importtime.
+
+    Python's own startup, before the imports of this file, is not included."""
+    log.info("Startup time:  seconds | phase")
+    for (phase, seconds) in startup_times.items():
+        log.info(f"              {seconds:8.3f} | {phase}")
+    for (name, seconds) in jktools.import_times.items(): # Included in the phases above
+        log.info(f"              {seconds:8.3f} |   import {name}")
+    log.info(f"              {sum(startup_times.values()):8.3f} | total")
+
+def run_statistics(stats, nfiles, nfailed, processing_time):
+    """Statistics of a run as a dict. stats = (times, counts) from GeoDataSet.pop_stats().
+
+    With several processes, the timers are summed over them and can be more than the elapsed time.
+    write_wait is the time the main process waited for the pipeline writer process."""
+    (times, counts) = stats
+    rows = counts.get("rows", 0)
+    return { 'version': version,
+        'files': nfiles, 'files_failed': nfailed, 'rows': rows, 
+        'elapsed_seconds': round(time.time() - starttime, 3), 
+        'processing_seconds': round(processing_time, 3), 
+        'rows_per_second': round(rows / processing_time, 1) if processing_time else None,
+        'timers': { k: round(times.get(k, 0.0), 4) for k in ["load", "read", "normalise", "match", "apply", "write", "write_wait"] },
+        'counts': { k: counts.get(k, 0) for k in ["skipped", "no_match", "unique_match", "multiple_matches", 
+            "rule_evaluations", "cache_hits", "cache_misses", "reused", "coordinates_checked", "coordinates_far"] } }
+
 #  ------------------ main script
-atexit.register(onexit)
 
 # READ CONFIGURATION AND KNOWN DATA FILES
 if __name__ == '__main__':
-    try: 
+    try:
         # Read command line
         ap =argparse.ArgumentParser(description='Georeferense Excel files with geodata information')
         ap.add_argument('conffn', metavar='conffn', nargs=1, help='configuration file name')
-        ap.add_argument('input_files', metavar='input_files', nargs='+', help='input data file(s)')
+        ap.add_argument('input_files', metavar='input_files', nargs='*', help='input data file(s)')
+        ap.add_argument('--workers', metavar='N', type=int, default=1, help='number of processes used for matching (default 1)')
+        ap.add_argument('--jobs', metavar='N', type=int, default=1, help='number of input files processed at the same time, each in its own process (default 1)')
+        ap.add_argument('--stats', choices=['text', 'json'], default=None, help='report time spent and row counts at the end, as log messages or JSON to standard output')
+        ap.add_argument('--incremental', action='store_true', 
+            help='reuse the match results of the previous run (kept in a .state file next to the output file) and replace its output file')
+        ap.add_argument('--profile', nargs='?', const='cprofile', choices=['cprofile', 'sampling'], default=None, 
+            help='profile the processing of each file, results are written next to the output file (default cprofile, sampling needs pyinstrument)')
+        ap.add_argument('--serve', metavar='ADDRESS', nargs='?', const=default_service_address, default=None, 
+            help=f'keep the known data loaded and serve match requests and file jobs on host:port or unix:path (default {default_service_address})')
+        ap.add_argument('--row-log', action='store_true', 
+            help='write the row number, number of matches and matched known data rows of each matched row to a JSON lines file next to the output file')
+        ap.add_argument('--check-config', action='store_true', help='only check the configuration file and that the known data files exist')
+        ap.add_argument('--startup-times', action='store_true', help='report the time spent in each startup phase, until the known data is loaded')
         args = ap.parse_args()
+        if not args.check_config and bool(args.input_files) == bool(args.serve): ap.error("give either input files or --serve")
+        lap("arguments")
 
+        atexit.register(onexit)
         executedir = Path(sys.argv[0]).parent
         log = createlogger( executedir / Path(progname + ".log") )
         log.info(f"Starting {progname} on {datetime.datetime.now()}")
         input_files  = [Path(x) for x in args.input_files]
+        lap("logging")
 
         # Read parameters from config file
         conffn = Path(args.conffn[0]) 
         log.info( f"Reading configuration file {conffn}"  )
         c = read_TOML_config(conffn) # CONFIG DATA 
 
-        inc_sheetname = c['inputfiles'].get('sheetname', None)
-        inc_first_data_line = c['inputfiles'].get('first_data_line', 2)
-        ignorechars = c.get('ignore_in_comparison',"")
-        # Regular expression replacements
-        if 'replacements' in c['inputfiles']:
-            regular_subs = c['inputfiles']['replacements']
-        else: regular_subs = {}
-
-        knownd_keep = c['knowndatafiles'].get('keep_original_data_marker').lower()
-        knownd_sheetnames = c['knowndatafiles'].get('sheetname',None)
-        knownd_filenames = [ Path(x) for x in  c['knowndatafiles'].get('filenames') ]  
-        try:
-            cmd_replace = c['knowndatafiles']['cmd_replace']
-            cmd_append = c['knowndatafiles']['cmd_append']
-            cmd_fillempty = c['knowndatafiles']['cmd_fillempty']
-            cmd_nothing = c['knowndatafiles']['cmd_nothing']
-        except LookupError as msg: raise jkError(f"Command names must be defined in the config file: {msg}.")
-        outputops = [cmd_replace, cmd_append, cmd_fillempty, cmd_nothing]
-        activeops = [cmd_replace, cmd_append, cmd_fillempty]
-
-        pnote = c['outputfiles'].get('transcribernote', "") 
-        if c['outputfiles'].get('transcribernote_appendfilenames', False):
-            pnote += " "
-            pnote += ", ".join((str(x) for x in knownd_filenames) )
-        output_marker = c['outputfiles'].get('filename_add')
-        if c['outputfiles'].get('add_date_to_note'):
-            pnote = pnote + " (%s)" % datetime.date.today()
-        outputformat = c['outputfiles'].get('output_format')
-        outputformat = outputformat.lower()
-        if outputformat not in ['csv', 'xlsx',  'fast-xlsx']: 
-            log.critical(f"Unknown output format: {outputformat.upper()}"); sys.exit()
-            
-        log.info(f"Output format: {outputformat.upper()}")
-
-        if pnote: pnotecolname = c['outputfiles'].get('transcribernotefield')
-        itemsep = c['outputfiles'].get('data_append_connector') + " "
-        new_field_insert_point = c['outputfiles'].get('new_column_insertion_position')
-
-        original_geodata_header = c['outputfiles'].get('original_geodata_to_column_header')
-        append_original_geodata_to_column = c['outputfiles'].get('append_original_geodata_to_column',None)
-        skip_if_content_columnnames = c['inputfiles'].get('skip_if_nonempty',[]) # Empty list default
-        skip_if_content_columnnames = [x.lower() for x in skip_if_content_columnnames]
-        log.debug(f"skipping row if content if found in columns {skip_if_content_columnnames}")
-
-        # Data file object placeholders
-        outdata = None
-        geodata = None
-
-        # Read geodata files
-        for knowdatafn in knownd_filenames:
-            geodatalist = []
-            log.info(f"Loading geodata from file {knowdatafn}")
-            geodata = jksheet.GeoData.fromfile(Path(knowdatafn), 
-                knownd_sheetnames, 
-                first_data_line_of_geodata)     
-            log.debug("Parsing rules from geodata file headers")
-            rules = geodata.parse_rules(known_test_types) # Parse row matching rules from GeoData file header rows
-            geodatalist.append( geodata )
-            #log.debug(f"Found the following test rules:")
-            for rule in rules: log.info(f"Rule for column {rule.colname}, rule type '{rule.type}'")
+        settings = read_settings(c)
+        settings.incremental = args.incremental
+        settings.row_log = args.row_log
+        log.info(f"Output format: {settings.outputformat.upper()}")
+        normalizer = Normalizer(settings.ignorechars, settings.regular_subs)
+        lap("config")
+        if args.check_config:
+            missing = [ str(fn) for fn in settings.knownd_filenames if not fn.is_file() ]
+            if missing: raise jkError(f"Known data files not found: {', '.join(missing)}.")
+            log.info(f"Configuration file {conffn} is OK")
+            if args.startup_times: write_startup_times()
+            sys.exit()
+        geodataset = load_geodata(settings)
+        lap("known data")
+        if args.startup_times: write_startup_times()
 
     except (FileNotFoundError,  jkError) as err: 
         log.critical(f"{err} Exiting.")
         sys.exit()
 
+    if args.serve:
+        try: serve(args.serve, geodataset, normalizer, settings)
+        except (jkError,  OSError) as err: log.critical(f"{err} Exiting.")
+        sys.exit()
+
     # PROCESS INPUT FILES 
-    for infn in input_files:   
-        # Read user data file
-        log.info(f"\n\nProcessing file {infn}") 
-        try:
-            # OPEN INPUT DATA
-            indata = jksheet.roExcel(infn, inc_first_data_line)            
-            # SETUP FOR OUTPUT FILE
-            outfn = create_output_name(infn, output_marker)        
-            if outputformat == 'fast-xlsx': 
-                outfn = outfn.with_suffix(".out.xlsx") 
-                outdata = jksheet.woExcel(outfn,inc_first_data_line)
-                outdata.fill_edited_color("fa867e")
-            else:
-                log.critical(f"Unknown output format {outputformat} exists. Exiting."); sys.exit()            
-#            elif outputformat == 'csv':
-#                outdata = jksheet.CSVOut.fromfile(infn, inc_sheetname) # Copy existing data
-#                origfn = outfn
-#                outfn = outfn.with_suffix("out.csv") 
-            if outfn.exists(): 
-                log.critical(f"File {outfn} exists. Will not overwrite. Exiting."); sys.exit()            
-
-            firstrow = indata.next_row()
-            # Verify that 1st line is valid
-            for i in range(len(firstrow)):
-                if not firstrow[i]: 
-                    raise ValueError(f"File {indata.filename}, column {i+1}: Empty column name (first row) not allowed.")
-
-            # ADD COLUMNS INTO OUTPUT IF CONFIG OR KNOWN DATA CONTAIN COLS NOT IN INPUT
-            for name in firstrow[::-1]:  # Grab first row. Reverse order to as insertion re-reverses them
-                    outdata.addcolumn(1,  [name])                
-            for colname in geodata.output_column_names(activeops)[::-1]:  # Reverse order to as insertion re-reverses them
-                if not outdata.hascolumn(colname):
-                    log.info(f"adding column {colname} to output table")
-                    outdata.addcolumn(new_field_insert_point,  [colname])
-            if pnotecolname and pnote:
-                if not outdata.hascolumn(pnotecolname):
-                    log.info(f"adding column {pnotecolname} to output table")
-                    outdata.addcolumn(new_field_insert_point, [pnotecolname])
-            if append_original_geodata_to_column:
-                if not outdata.hascolumn(append_original_geodata_to_column):
-                    log.info(f"adding column {append_original_geodata_to_column} to output table")
-                    outdata.addcolumn(new_field_insert_point ,  [append_original_geodata_to_column]) 
-
-            # Step through input file and process line by line
-            # 1st line (header line) has already been read
-            rowcount = 2
-            while not indata.end(): 
-                if (rowcount % 10) == 0: log.info(f"Processing row {rowcount}") 
-                origdict = indata.next_row_as_dict() 
-                outdict =  origdict.copy()
-                edited = { k: False for k in outdict.keys() } # Edit status for each item on this row
+    processing_started = time.perf_counter()
+    failed = {} # input file -> error message
+    njobs = min(args.jobs, len(input_files))
+    if args.profile and (njobs > 1 or args.workers > 1):
+        log.info("--workers and --jobs are ignored when profiling")
+        (njobs, args.workers) = (1, 1)
+    if njobs > 1:
+        # Batch mode: one file per process. Each process gets a copy of the known data once.
+        # A file's log messages are logged together when the file is done.
+        if args.workers > 1: log.info("--workers is ignored when processing several files at the same time")
+        log.info(f"Processing {len(input_files)} files in {njobs} processes")
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(njobs,
+                initializer=_init_worker, initargs=(geodataset, normalizer, settings)) as jobpool:
+            # Largest files first, so that the last job to finish is a short one
+            bysize = sorted(input_files, key=lambda fn: fn.stat().st_size if fn.exists() else 0, reverse=True)
+            futures = { jobpool.submit(_process_file_job, infn): infn for infn in bysize }
+            for future in concurrent.futures.as_completed(futures):
+                infn = futures[future]
                 try: 
-                    if rowcount < inc_first_data_line: # If this is a header line, just write
-                        raise WriteRow
-                    # If line has content in specified columns already, skip to WriteRow
-                    for skipname in skip_if_content_columnnames: 
-                        val = str(origdict.get(skipname,""))
-                        if val and val.strip(): # Has some content
-                            raise WriteRow 
-                    matchrows = geodata.find_matches( origdict, rules, normalize_dict=regular_subs )
-                    nmatch = len(matchrows)
-                    if nmatch == 0:  
-                        raise WriteRow
-                    if nmatch > 1:  
-                        log.debug(f"Found multiple matches for inputrow {rowcount}: {matchrows}. Check geodata source file. Skipping row")
-                        raise WriteRow
-                    # OK, so we have exactly one match
-                    originaldata = [] # Kept to store original data from cells that may be replaced (for later reporting in the output)
-                    mrow = matchrows[0] # index of the single matching row
-                    match = geodata.get_result_dict(mrow, activeops) # match as a colname: val dictionary
-                    for colname,val in match.items():
-#                        print(colname,val )
-                        if my2str(val).strip().lower() == knownd_keep: 
-                            continue # Overrule marker in known_data
-                        # If column name is not in outdata, it is not an active output field name and can be ignored
-                        if colname.lower() not in outdata.lowercolnames: continue        
-                        # Copy original data to a field in the output file (not copying the output cell data into itself
-                        if append_original_geodata_to_column and (colname != append_original_geodata_to_column):  
-                            oval = origdict.get(colname,"")  
-                            if oval: originaldata.append(oval)
-                        # OK to here
-                        oper = geodata.get_output_action_for_column(colname, outputops) 
-                        if oper not in outputops:
-                            continue # Skip column with actions that are not output operations
-                        elif (oper == cmd_replace) or ( oper == cmd_fillempty and not outdict[colname] ):
-                            outdict[colname] = val
-                            edited[colname] = op_replaced
-                        elif oper == cmd_append and val: # Append non-empty values only
-                            outdict[colname] = joinstr( outdict.get(colname,"" ),  val ,  itemsep ) 
-                            edited[colname] = op_appended
-                    if append_original_geodata_to_column: # Append old data to designated cell
-                            origstr = f"{original_geodata_header} {itemsep.join(originaldata)}" 
-                            cn = append_original_geodata_to_column.lower()
-                            outdict[cn] = joinstr(outdict.get(cn,"" ),  origstr ,  "") 
-                            edited[cn] = True
-                    # Add note by the program, if available
-                    if pnotecolname and pnote:
-                        cn = pnotecolname.lower()
-                        outdict[cn] = joinstr(outdict.get(cn,"" ),  pnote ,  itemsep) 
-                        edited[cn] = True
-                    raise WriteRow
-                except WriteRow:
-                    outdata.itersetrow(outdict,  edited)
-                    next(outdata) # Move to next line in outdata
-                    rowcount += 1
-            log.info(f"Saving output file {outfn}")
-            if not _SUPPRESS_FILE_CREATION_FOR_TESTING:
-                outdata.close()
-        except (jkError,  FileNotFoundError,  ValueError) as msg:
-            log.critical(msg)
-            sys.exit() 
+                    (error, records, stats) = future.result()
+                    geodataset.add_stats(stats)
+                except Exception as err: # Worker process died
+                    (error, records) = (f"{type(err).__name__}: {err}", [])
+                    log.critical(f"File {infn}: {error}")
+                for record in records: logging.getLogger(record.name).handle(record) # Row log records to rowlog
+                if error: failed[infn] = error
+    else:
+        # Worker processes for matching, if requested. They get a copy of the known data once.
+        pool = None
+        if args.workers > 1 and args.incremental:
+            log.info("--workers is ignored in incremental runs")
+        elif args.workers > 1:
+            log.info(f"Using {args.workers} worker processes")
+            import concurrent.futures
+            pool = concurrent.futures.ProcessPoolExecutor(args.workers,
+                initializer=_init_worker, initargs=(geodataset, normalizer, settings))
+        for infn in input_files:   
+            try:
+                if args.profile: profile_file(infn, geodataset, normalizer, settings, args.profile)
+                else: process_file(infn, geodataset, normalizer, settings, pool, args.workers)
+            except (jkError,  FileNotFoundError,  ValueError,  OSError) as msg:
+                log.critical(msg)
+                failed[infn] = str(msg)
+            except Exception as err: # One failed file must not stop the others, as with --jobs
+                log.critical(traceback.format_exc())
+                failed[infn] = f"{type(err).__name__}: {err}"
+        if pool: pool.shutdown()
+
+    processing_time = time.perf_counter() - processing_started
+    stats = run_statistics(geodataset.pop_stats(), len(input_files), len(failed), processing_time)
+    (hits, misses) = (stats['counts']['cache_hits'], stats['counts']['cache_misses'])
+    if hits + misses:
+        log.info(f"Match result cache: {hits} hits, {misses} misses, hit rate {hits/(hits + misses):.1%}")
+    if args.stats == 'json':
+        print(json.dumps(stats, indent=2))
+    elif args.stats == 'text':
+        log.info(f"\n\n{stats['rows']} rows in {stats['processing_seconds']:.2f} s, {stats['rows_per_second'] or 0:.0f} rows/s")
+        for (k, v) in stats['timers'].items(): log.info(f"  {k:20s} {v:10.3f} s")
+        for (k, v) in stats['counts'].items(): log.info(f"  {k:20s} {v:10d}")
+    if len(input_files) > 1:
+        log.info(f"\n\n{len(input_files) - len(failed)} of {len(input_files)} files processed successfully")
+        for infn in input_files:
+            if infn in failed: log.info(f"  FAILED  {infn}: {failed[infn]}")
+            else: log.info(f"  OK      {infn}")
 
     # Ask for any input before closing window
     # Now handled to a OS script wrapper (.bat on Windows)